@@ -0,0 +1,449 @@
+"""Công cụ đo offline cho pipeline ảnh chào mừng (không cần kết nối Discord).
+
+    python bench.py colors      # so sánh màu chủ đạo giữa chế độ numpy và colorthief
+    python bench.py encode      # kích thước / thời gian encode ảnh chào mừng theo từng định dạng
+    python bench.py load        # đo throughput create_welcome_image với CDN giả lập, ghi kết quả JSON
+    python bench.py shards      # phân bổ guild / sự kiện giả lập theo shard và process, kiểm tra số liệu /metrics
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import random
+import resource
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit, urlunsplit, urlencode
+
+import aiohttp
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+import main
+
+
+# --- Bộ ảnh mẫu ---
+def _png_bytes(img):
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+def _gradient(size, start, end):
+    img = Image.new('RGB', (size, size))
+    draw = ImageDraw.Draw(img)
+    for y in range(size):
+        t = y / (size - 1)
+        draw.line([(0, y), (size, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(start, end)))
+    return img
+
+def _accent(size, base, accent, ratio):
+    img = Image.new('RGBA' if len(base) == 4 else 'RGB', (size, size), base)
+    inset = int(size * (1 - ratio) / 2)
+    ImageDraw.Draw(img).ellipse((inset, inset, size - inset, size - inset), fill=accent)
+    return img
+
+def color_fixtures():
+    """Trả về danh sách (tên, bytes ảnh) dùng để so sánh các chế độ lấy màu."""
+    fixtures = []
+    for path in ("avatar.png", "stroke.png"):
+        try:
+            with open(path, 'rb') as f:
+                fixtures.append((path, f.read()))
+        except FileNotFoundError:
+            print(f"DEBUG: Bỏ qua ảnh mẫu không tồn tại: {path}")
+    fixtures += [
+        ("solid-purple", _png_bytes(Image.new('RGB', (256, 256), (150, 60, 220)))),
+        ("solid-gray", _png_bytes(Image.new('RGB', (256, 256), (128, 128, 128)))),
+        ("solid-black", _png_bytes(Image.new('RGB', (256, 256), (5, 5, 5)))),
+        ("gradient-sunset", _png_bytes(_gradient(512, (255, 120, 40), (90, 20, 140)))),
+        ("gradient-sea", _png_bytes(_gradient(512, (10, 40, 90), (60, 220, 200)))),
+        ("dark-with-pink", _png_bytes(_accent(512, (20, 20, 25), (240, 80, 170), 0.6))),
+        ("pale-with-green", _png_bytes(_accent(512, (235, 235, 230), (60, 200, 90), 0.5))),
+        ("transparent-orange", _png_bytes(_accent(256, (0, 0, 0, 0), (250, 150, 30, 255), 0.7))),
+    ]
+    return fixtures
+
+
+def _color_distance(a, b):
+    return math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+
+def _stroke_color(rgb):
+    # So sánh trên màu viền thực sự hiển thị, giống render_welcome_image
+    return main.adjust_color_brightness_saturation(rgb, brightness_factor=1.1, saturation_factor=4.9, clamp_min_l=0.6, clamp_max_l=0.90)
+
+def run_colors(args):
+    """So sánh màu viền do hai chế độ chọn ra; trả về mã thoát khác 0 nếu lệch quá ngưỡng."""
+    failures = 0
+    print(f"{'ảnh mẫu':<20} {'colorthief':>16} {'ms':>8} {'numpy':>16} {'ms':>8} {'lệch':>6}")
+    for name, data in color_fixtures():
+        t0 = time.perf_counter()
+        ct_color = main._extract_dominant_color(data, mode="colorthief")
+        ct_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        avatar_img = main._decode_avatar(data, main.AVATAR_SIZE)
+        np_color = main._extract_dominant_color(data, avatar_img=avatar_img, mode="numpy")
+        np_ms = (time.perf_counter() - t0) * 1000
+        distance = _color_distance(_stroke_color(ct_color), _stroke_color(np_color))
+        flag = "" if distance <= args.tolerance else "  <-- LỆCH"
+        failures += bool(flag)
+        print(f"{name:<20} {str(ct_color):>16} {ct_ms:8.1f} {str(np_color):>16} {np_ms:8.1f} {distance:6.1f}{flag}")
+    print(f"Kết quả: {failures} ảnh lệch quá ngưỡng {args.tolerance}.")
+    return 1 if failures else 0
+
+
+ENCODE_MODES = [
+    ("png", {"image_format": "png", "compress_level": 6}),
+    ("png-c1", {"image_format": "png", "compress_level": 1}),
+    ("png-c3", {"image_format": "png", "compress_level": 3}),
+    ("png-rgb-c1", {"image_format": "png-rgb", "compress_level": 1}),
+    ("png-rgb-c6", {"image_format": "png-rgb", "compress_level": 6}),
+    ("png-palette", {"image_format": "png-palette", "compress_level": 6}),
+    ("webp", {"image_format": "webp"}),
+]
+
+def run_encode(args):
+    """In kích thước và thời gian encode trung bình của từng chế độ trên cùng một ảnh đã ghép."""
+    with open(args.avatar, 'rb') as f:
+        avatar_bytes = f.read()
+    img, _ = main.compose_welcome_image(avatar_bytes, args.name)
+    print(f"{'chế độ':<14} {'KB':>8} {'ms/ảnh':>8}")
+    for label, kwargs in ENCODE_MODES:
+        timings = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            data = main._encode_welcome_image(img, **kwargs)
+            timings.append((time.perf_counter() - t0) * 1000)
+        print(f"{label:<14} {len(data) / 1024:8.1f} {sum(timings) / len(timings):8.1f}")
+    return 0
+
+
+# --- Load generator: CDN giả lập + member giả ---
+LOAD_NAMES = [
+    "Nguyễn Thị Ánh Dương",
+    "Trần Đức Việt",
+    "Lê Hoàng Phúc 🎮",
+    "✦ Dawn_wibu ✦",
+    "★彡 𝓜𝓵𝓮𝓶 彡★",
+    "user_123",
+    "Phạm Quỳnh Như 💖✨",
+    "A very long display name that gets cut off",
+]
+
+def _encode(img, fmt, **kwargs):
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **kwargs)
+    return buf.getvalue()
+
+def avatar_fixtures():
+    """Avatar mẫu với nhiều kích thước/định dạng: {tên file: (bytes, content-type, động?)}."""
+    base = Image.open("avatar.png").convert("RGB")
+    frames = [base.resize((128, 128)), _gradient(128, (255, 0, 120), (0, 90, 255)), _gradient(128, (40, 220, 90), (250, 240, 40))]
+    gif = io.BytesIO()
+    frames[0].save(gif, format="GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return {
+        "big.png": (_encode(base.resize((1024, 1024)), "PNG"), "image/png", False),
+        "photo.jpg": (_encode(base.resize((512, 512)), "JPEG", quality=90), "image/jpeg", False),
+        "small.webp": (_encode(base.resize((256, 256)), "WEBP"), "image/webp", False),
+        "a_anim.gif": (gif.getvalue(), "image/gif", True),
+        "alpha.png": (_encode(_accent(256, (0, 0, 0, 0), (250, 150, 30, 255), 0.8), "PNG"), "image/png", False),
+        "default.png": (_encode(Image.new("RGB", (256, 256), (88, 101, 242)), "PNG"), "image/png", False),
+    }
+
+class StubCDN:
+    """HTTP server cục bộ thay cho CDN Discord; hỗ trợ ?size= và đổi đuôi định dạng như CDN thật."""
+
+    CONTENT_TYPES = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg"),
+                     "jpeg": ("JPEG", "image/jpeg"), "gif": ("GIF", "image/gif")}
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.requests = 0
+        self.bytes_served = 0
+        self._variants = {}
+        self._runner = None
+        self.base_url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/avatars/{name}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _variant(self, stem, ext, size):
+        key = (stem, ext, size)
+        if key not in self._variants:
+            source = next((v for k, v in self.fixtures.items() if k.rsplit(".", 1)[0] == stem), None)
+            if source is None or ext not in self.CONTENT_TYPES:
+                return None
+            img = Image.open(io.BytesIO(source[0]))
+            img.seek(0)
+            img = img.convert("RGBA")
+            if size:
+                img = img.resize((size, size), Image.LANCZOS)
+            fmt, content_type = self.CONTENT_TYPES[ext]
+            if fmt == "JPEG":
+                img = img.convert("RGB")
+            self._variants[key] = (_encode(img, fmt), content_type)
+        return self._variants[key]
+
+    async def _handle(self, request):
+        name = request.match_info["name"]
+        size = request.query.get("size")
+        self.requests += 1
+        if name in self.fixtures and not size:
+            data, content_type, _ = self.fixtures[name]
+        else:
+            stem, _, ext = name.rpartition(".")
+            variant = self._variant(stem, ext, int(size) if size else None)
+            if variant is None:
+                raise web.HTTPNotFound()
+            data, content_type = variant
+        self.bytes_served += len(data)
+        return web.Response(body=data, content_type=content_type)
+
+class StubAsset:
+    """Giống discord.Asset ở những gì create_welcome_image dùng: url, key, is_animated(), replace()."""
+
+    def __init__(self, url, key, animated=False):
+        self.url = url
+        self.key = key
+        self._animated = animated
+
+    def is_animated(self):
+        return self._animated
+
+    def replace(self, size=None, format=None, static_format=None):
+        parts = urlsplit(self.url)
+        path, _, ext = parts.path.rpartition(".")
+        if format:
+            ext = format
+        if static_format and not self._animated:
+            ext = static_format
+        query = urlencode({"size": size}) if size else parts.query
+        return StubAsset(urlunsplit((parts.scheme, parts.netloc, f"{path}.{ext}", query, "")), self.key, self._animated)
+
+class StubGuild:
+    id = 0
+    name = "Bench Guild"
+
+class StubMember:
+    def __init__(self, index, display_name, avatar, default_avatar):
+        self.id = index
+        self.display_name = display_name
+        self.mention = f"<@{index}>"
+        self.avatar = avatar
+        self.default_avatar = default_avatar
+        self.guild = StubGuild()
+
+def stub_members(cdn, count):
+    names = sorted(cdn.fixtures)
+    default_avatar = StubAsset(f"{cdn.base_url}/avatars/default.png", "0")
+    members = []
+    for i in range(count):
+        fixture = names[i % len(names)]
+        avatar = None
+        if fixture != "default.png":
+            avatar = StubAsset(f"{cdn.base_url}/avatars/{fixture}", f"hash-{fixture}", animated=cdn.fixtures[fixture][2])
+        # Tên khác nhau giữa các lượt để cache ảnh hoàn chỉnh không che mất thời gian render
+        members.append(StubMember(i, f"{LOAD_NAMES[i % len(LOAD_NAMES)]}"[:20] + f" {i}", avatar, default_avatar))
+    return members
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def _peak_rss_mb():
+    # ru_maxrss tính bằng KB trên Linux; cộng thêm các process render con nếu dùng RENDER_BACKEND=process
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+async def _run_level(members, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(member):
+        async with semaphore:
+            trace = main.WelcomeTrace(f"bench:{member.display_name}")
+            t0 = time.perf_counter()
+            await main.create_welcome_image(member, trace)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            trace.finish()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(m) for m in members))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(members),
+        'elapsed_s': elapsed,
+        'images_per_s': len(members) / elapsed if elapsed else 0.0,
+        'p50_ms': _percentile(latencies, 0.50),
+        'p95_ms': _percentile(latencies, 0.95),
+        'p99_ms': _percentile(latencies, 0.99),
+        'max_ms': latencies[-1] if latencies else 0.0,
+    }
+
+async def _run_load(args):
+    main.WELCOME_TRACE_SLOW_MS = float("inf")
+    if not args.with_cache:
+        # Đo đường lạnh: tắt cache màu / ảnh hoàn chỉnh; cache avatar được xóa trước mỗi mức đồng thời
+        main.WELCOME_CARD_CACHE.max_bytes = 0
+        main.WELCOME_COLOR_CACHE.max_bytes = 0
+    cdn = StubCDN(avatar_fixtures())
+    await cdn.start()
+    main.bot.session = aiohttp.ClientSession()
+    main._build_render_template()
+    main._start_render_executor()
+    levels = []
+    try:
+        members = stub_members(cdn, args.requests)
+        # Làm nóng: tải font/glyph, khởi động process pool
+        await _run_level(members[:min(len(members), 4)], 2)
+        for concurrency in args.concurrency:
+            if not args.with_cache:
+                main.avatar_cache.clear()
+            result = await _run_level(members, concurrency)
+            levels.append(result)
+            print(f"đồng thời={concurrency:<3} {result['images_per_s']:7.2f} ảnh/s  p50={result['p50_ms']:7.1f}ms  "
+                  f"p95={result['p95_ms']:7.1f}ms  p99={result['p99_ms']:7.1f}ms")
+    finally:
+        await main.bot.session.close()
+        await cdn.stop()
+        if main.RENDER_EXECUTOR is not None:
+            main.RENDER_EXECUTOR.shutdown()
+    own_rss, children_rss = _peak_rss_mb()
+    print(f"RSS đỉnh: {own_rss:.1f} MB (process render con: {children_rss:.1f} MB); CDN giả đã phục vụ {cdn.requests} request, {cdn.bytes_served / 1024:.0f} KB")
+    return {
+        'timestamp': time.time(),
+        'git_revision': _git_revision(),
+        'config': {
+            'render_backend': main.RENDER_BACKEND,
+            'render_workers': main.RENDER_WORKERS,
+            'dominant_color_mode': main.DOMINANT_COLOR_MODE,
+            'image_format': main.WELCOME_IMAGE_FORMAT,
+            'png_compress_level': main.WELCOME_PNG_COMPRESS_LEVEL,
+            'avatar_cdn_format': main.AVATAR_CDN_FORMAT,
+            'with_cache': args.with_cache,
+            'requests': args.requests,
+        },
+        'levels': levels,
+        'peak_rss_mb': own_rss,
+        'peak_rss_children_mb': children_rss,
+        'cdn': {'requests': cdn.requests, 'bytes': cdn.bytes_served},
+        'stages': main.welcome_trace_stats()['stages'],
+    }
+
+def _compare_with_baseline(result, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {level['concurrency']: level for level in baseline.get('levels', [])}
+    print(f"So với {baseline_path} (commit {baseline.get('git_revision')}):")
+    for level in result['levels']:
+        old = previous.get(level['concurrency'])
+        if not old:
+            continue
+        def delta(key):
+            return (level[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f"  đồng thời={level['concurrency']:<3} ảnh/s {delta('images_per_s'):+6.1f}%  p50 {delta('p50_ms'):+6.1f}%  p95 {delta('p95_ms'):+6.1f}%")
+
+def run_load(args):
+    result = asyncio.run(_run_load(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Đã ghi kết quả vào {args.output}")
+    if args.baseline:
+        _compare_with_baseline(result, args.baseline)
+    return 0
+
+
+# --- Sharding với sự kiện giả lập ---
+class StubShardGuild:
+    def __init__(self, guild_id, shard_count):
+        self.id = guild_id
+        self.shard_id = main.shard_for_guild(guild_id, shard_count)
+
+
+def run_shards(args):
+    rng = random.Random(args.seed)
+    # Snowflake giả: timestamp ngẫu nhiên ở 42 bit cao như id guild thật
+    guilds = [StubShardGuild((rng.randrange(1 << 40) << 22) | rng.randrange(1 << 22), args.shard_count) for _ in range(args.guilds)]
+    # Vài server bận chiếm phần lớn lưu lượng, giống thực tế
+    weights = [rng.paretovariate(1.2) for _ in guilds]
+    events = ("message", "member_update", "member_join")
+    main.SHARD_EVENT_COUNTS.clear()
+    main.update_shard_event_rates(now=0.0)
+    for _ in range(args.events):
+        main.count_shard_event(rng.choices(guilds, weights)[0], rng.choices(events, (90, 9, 1))[0])
+    main.update_shard_event_rates(now=args.seconds)
+
+    per_process = max(1, math.ceil(args.shard_count / args.processes))
+    print(f"{'shard':>5} {'process':>7} {'guild':>6} {'sự kiện':>8} {'sự kiện/s':>10}")
+    for shard_id in range(args.shard_count):
+        shard_guilds = sum(1 for guild in guilds if guild.shard_id == shard_id)
+        shard_events = sum(count for (sid, _), count in main.SHARD_EVENT_COUNTS.items() if sid == shard_id)
+        shard_rate = sum(rate for (sid, _), rate in main.SHARD_EVENT_RATES.items() if sid == shard_id)
+        print(f"{shard_id:>5} {shard_id // per_process:>7} {shard_guilds:>6} {shard_events:>8} {shard_rate:>10.1f}")
+    for process in range(args.processes):
+        first = process * per_process
+        last = min(args.shard_count, first + per_process) - 1
+        if first <= last:
+            print(f"process {process}: SHARD_COUNT={args.shard_count} SHARD_IDS={first}-{last}")
+
+    metrics = [line for line in main.build_metrics_text().splitlines() if line.startswith("botmlem_shard_event")]
+    print(f"/metrics có {len(metrics)} dòng số liệu theo shard.")
+    return 0 if metrics else 1
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    colors = sub.add_parser("colors", help="So sánh màu chủ đạo giữa chế độ numpy và colorthief")
+    colors.add_argument("--tolerance", type=float, default=60.0, help="Độ lệch RGB tối đa cho phép giữa màu viền của hai chế độ")
+    colors.set_defaults(func=run_colors)
+    encode = sub.add_parser("encode", help="So sánh kích thước và thời gian encode theo từng định dạng")
+    encode.add_argument("--avatar", default="avatar.png", help="Ảnh avatar dùng để ghép ảnh mẫu")
+    encode.add_argument("--name", default="Nguyễn Văn Ánh ✦ test", help="Tên hiển thị trên ảnh mẫu")
+    encode.add_argument("--repeat", type=int, default=5, help="Số lần encode mỗi chế độ để lấy trung bình")
+    encode.set_defaults(func=run_encode)
+    load = sub.add_parser("load", help="Đo độ trễ / throughput create_welcome_image với CDN giả lập")
+    load.add_argument("--requests", type=int, default=48, help="Số ảnh render ở mỗi mức đồng thời")
+    load.add_argument("--concurrency", type=lambda v: [int(x) for x in v.split(",")], default=[1, 2, 4, 8],
+                      help="Các mức đồng thời, phân cách bằng dấu phẩy")
+    load.add_argument("--with-cache", action="store_true", help="Giữ cache màu / ảnh hoàn chỉnh (mặc định đo đường lạnh)")
+    load.add_argument("--output", default="bench_results.json", help="File JSON ghi kết quả")
+    load.add_argument("--baseline", help="File JSON của lần đo trước để so sánh")
+    load.set_defaults(func=run_load)
+    shards = sub.add_parser("shards", help="Phân bổ guild / sự kiện giả lập theo shard và process")
+    shards.add_argument("--shard-count", type=int, default=4, help="Tổng số shard")
+    shards.add_argument("--processes", type=int, default=2, help="Số process chia shard")
+    shards.add_argument("--guilds", type=int, default=200, help="Số guild giả lập")
+    shards.add_argument("--events", type=int, default=20000, help="Số sự kiện giả lập")
+    shards.add_argument("--seconds", type=float, default=60.0, help="Khoảng thời gian giả định của các sự kiện (tính tốc độ)")
+    shards.add_argument("--seed", type=int, default=1, help="Seed ngẫu nhiên")
+    shards.set_defaults(func=run_shards)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
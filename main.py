@@ -2,14 +2,30 @@ import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 import os
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageFilter
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageFilter, ImageChops
 import io
 import aiohttp
+from aiohttp import web
 import asyncio
 import random
 import threading
+import sys
 import traceback
-from flask import Flask
+import time
+import math
+import logging
+import resource
+import concurrent.futures
+import multiprocessing
+import json
+import sqlite3
+import zipfile
+import re
+import hashlib
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import numpy as np
+from flask import Flask, Response, request
 from colorthief import ColorThief
 
 # --- Khởi tạo Flask app ---
@@ -33,33 +49,575 @@ def home():
 def health_check():
     return "OK", 200
 
+# Snapshot số liệu do metrics_snapshot_worker dựng trên event loop; thread Flask chỉ đọc chuỗi đã dựng sẵn
+METRICS_SNAPSHOT = {'text': "", 'updated_at': 0.0}
+# /metrics cần token (header "Authorization: Bearer <token>" hoặc ?token=); không đặt METRICS_TOKEN thì chỉ mở cho localhost
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+def metrics_request_allowed(authorization, query_token, remote_addr):
+    if METRICS_TOKEN:
+        return authorization == f"Bearer {METRICS_TOKEN}" or query_token == METRICS_TOKEN
+    return remote_addr in ("127.0.0.1", "::1")
+
+@app.route('/metrics')
+def metrics():
+    if not metrics_request_allowed(request.headers.get("Authorization"), request.args.get("token"), request.remote_addr):
+        return "forbidden", 403
+    text = METRICS_SNAPSHOT['text'] or "# Chưa có snapshot số liệu\n"
+    return Response(text, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Route debug dùng token bot như /ping/<token>
+@app.route('/debug/stalls/<token>')
+def debug_stalls(token):
+    if token != os.getenv("DISCORD_BOT_TOKEN"):
+        return "forbidden", 403
+    return Response(format_loop_stalls(), content_type="text/plain; charset=utf-8")
+
+@app.route('/debug/profile/<token>')
+def debug_profile(token):
+    if token != os.getenv("DISCORD_BOT_TOKEN"):
+        return "forbidden", 403
+    seconds = request.args.get("seconds", 10, type=float)
+    # Thread Flask tự lấy mẫu, event loop không phải làm gì thêm
+    result = sample_loop_profile(seconds)
+    if result is None:
+        return "profiler đang chạy hoặc event loop chưa sẵn sàng", 409
+    return Response(result[0], content_type="text/plain; charset=utf-8")
+
 def run_flask():
     """Chạy Flask app trong 1 thread riêng"""
     port = int(os.environ.get("PORT", 10000))
     print(f"Flask server running on port {port}")
     app.run(host='0.0.0.0', port=port, debug=False)
 
+# --- Web server chạy ngay trên event loop của bot (WEB_SERVER_MODE=aiohttp) ---
+# "flask": Flask dev server trong thread riêng như cũ; "aiohttp": aiohttp.web trên cùng event loop, không thêm thread
+WEB_SERVER_MODE = os.getenv("WEB_SERVER_MODE", "flask").lower()
+
+async def _web_home(request):
+    return web.Response(text="Bot is alive and healthy!")
+
+async def _web_health_check(request):
+    return web.Response(text="OK")
+
+async def _web_ping_token(request):
+    if request.match_info['token'] != os.getenv("DISCORD_BOT_TOKEN"):
+        return web.Response(text="forbidden", status=403)
+    return web.Response(text="OK")
+
+async def _web_ping_random(request):
+    return web.Response(text=f"pong {request.match_info['rnum']}")
+
+async def _web_metrics(request):
+    if not metrics_request_allowed(request.headers.get("Authorization"), request.query.get("token"), request.remote):
+        return web.Response(text="forbidden", status=403)
+    # Cùng event loop với bot nên đọc trạng thái trực tiếp, không cần snapshot
+    return web.Response(body=build_metrics_text().encode("utf-8"), headers={'Content-Type': "text/plain; version=0.0.4; charset=utf-8"})
+
+async def _web_debug_stalls(request):
+    if request.match_info['token'] != os.getenv("DISCORD_BOT_TOKEN"):
+        return web.Response(text="forbidden", status=403)
+    return web.Response(text=format_loop_stalls())
+
+async def _web_debug_profile(request):
+    if request.match_info['token'] != os.getenv("DISCORD_BOT_TOKEN"):
+        return web.Response(text="forbidden", status=403)
+    try:
+        seconds = float(request.query.get("seconds", 10))
+    except ValueError:
+        seconds = 10
+    # Lấy mẫu trong thread khác, loop vẫn chạy bình thường (và chính là thứ được lấy mẫu)
+    result = await asyncio.to_thread(sample_loop_profile, seconds)
+    if result is None:
+        return web.Response(text="profiler đang chạy hoặc event loop chưa sẵn sàng", status=409)
+    return web.Response(text=result[0])
+
+def build_web_app():
+    web_app = web.Application()
+    web_app.router.add_get("/", _web_home)
+    web_app.router.add_get("/healthz", _web_health_check)
+    web_app.router.add_get("/ping/{token}", _web_ping_token)
+    web_app.router.add_get(r"/ping-r/{rnum:\d+}", _web_ping_random)
+    web_app.router.add_get("/metrics", _web_metrics)
+    web_app.router.add_get("/debug/stalls/{token}", _web_debug_stalls)
+    web_app.router.add_get("/debug/profile/{token}", _web_debug_profile)
+    return web_app
+
+async def start_web_server():
+    """Chạy web server aiohttp trên event loop hiện tại; trả về AppRunner để dọn dẹp khi tắt."""
+    port = int(os.environ.get("PORT", 10000))
+    runner = web.AppRunner(build_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    print(f"aiohttp web server running on port {port}")
+    return runner
+
 # --- Cấu hình Bot Discord ---
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.messages = True
-intents.members = True
-intents.voice_states = True
-intents.presences = True
+# --- Cấu hình gateway ---
+# "full": như cũ (presence + cache toàn bộ member/voice/tin nhắn).
+# "lean": tắt presence intent và cache voice/tin nhắn (bot chỉ dùng member join, đổi role và on_message).
+GATEWAY_PROFILE = os.getenv("GATEWAY_PROFILE", "full").lower()
+# Chunk member lúc khởi động; on_member_update chỉ chạy cho member đã có trong cache,
+# nên tắt chunk (=0) thì thông báo lên cấp có thể bỏ sót lần đổi role đầu tiên của member chưa được cache
+GATEWAY_CHUNK_GUILDS = os.getenv("GATEWAY_CHUNK_GUILDS", "1") == "1"
+
+def build_intents(profile=GATEWAY_PROFILE):
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.messages = True
+    intents.members = True
+    if profile == "lean":
+        intents.presences = False
+        intents.voice_states = False
+        intents.typing = False
+    else:
+        intents.voice_states = True
+        intents.presences = True
+    return intents
+
+def build_client_options(profile=GATEWAY_PROFILE):
+    """Tham số cache cho commands.Bot theo profile gateway."""
+    if profile != "lean":
+        return {'chunk_guilds_at_startup': GATEWAY_CHUNK_GUILDS}
+    return {
+        # Chỉ cache member (không cache trạng thái voice), không giữ cache tin nhắn vì không dùng tới
+        'member_cache_flags': discord.MemberCacheFlags(voice=False, joined=True),
+        'chunk_guilds_at_startup': GATEWAY_CHUNK_GUILDS,
+        'max_messages': None,
+    }
+
+intents = build_intents()
+
+# --- Sharding ---
+# SHARD_MODE=auto: AutoShardedBot với số shard Discord gợi ý, tất cả trong process này.
+# SHARD_COUNT=N (+ SHARD_IDS="0-3" hoặc "0,2,5"): cố định tổng số shard và chỉ chạy các shard được liệt kê,
+# để chia shard ra nhiều process. Mặc định (off) vẫn là một kết nối gateway như cũ.
+SHARD_MODE = os.getenv("SHARD_MODE", "off").lower()
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS_SPEC = os.getenv("SHARD_IDS", "").replace(" ", "")
+
+def parse_shard_ids(spec):
+    """"0-3,6" -> [0, 1, 2, 3, 6]; chuỗi rỗng -> None (mọi shard)."""
+    ids = set()
+    for part in spec.split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            ids.update(range(int(start), int(end) + 1))
+        else:
+            ids.add(int(part))
+    return sorted(ids) or None
+
+def build_shard_options():
+    """Tham số shard cho AutoShardedBot, hoặc None nếu không bật sharding."""
+    shard_ids = parse_shard_ids(SHARD_IDS_SPEC)
+    if SHARD_COUNT > 0:
+        if shard_ids and (shard_ids[0] < 0 or shard_ids[-1] >= SHARD_COUNT):
+            raise ValueError(f"SHARD_IDS={SHARD_IDS_SPEC} nằm ngoài khoảng 0..{SHARD_COUNT - 1}")
+        return {'shard_count': SHARD_COUNT, 'shard_ids': shard_ids}
+    if shard_ids:
+        raise ValueError("SHARD_IDS cần đi kèm SHARD_COUNT")
+    if SHARD_MODE == "auto":
+        return {}
+    return None
+
+def shard_for_guild(guild_id, shard_count):
+    """Công thức chia guild vào shard của Discord."""
+    return (guild_id >> 22) % shard_count if shard_count else 0
+
+SHARD_OPTIONS = build_shard_options()
+SHARD_IDS = SHARD_OPTIONS.get('shard_ids') if SHARD_OPTIONS else None
+# Process chạy shard 0 (hoặc không chia shard) là process duy nhất được sync slash command
+IS_PRIMARY_SHARD_PROCESS = SHARD_IDS is None or 0 in SHARD_IDS
 
-bot = commands.Bot(command_prefix="!", intents=intents, reconnect=True)
+if SHARD_OPTIONS is not None:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, reconnect=True, **build_client_options(), **SHARD_OPTIONS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, reconnect=True, **build_client_options())
+
+# --- Kênh chào mừng và hàng đợi join ---
+WELCOME_CHANNEL_ID = 1322848542758277202
+DISCORD_MAX_FILES = 10
+JOIN_RENDER_WORKERS = int(os.getenv("JOIN_RENDER_WORKERS", "2"))
+JOIN_QUEUE_MAX = int(os.getenv("JOIN_QUEUE_MAX", "200"))
+# Quá ngưỡng này lượt join mới chỉ được chào bằng chữ
+JOIN_TEXT_ONLY_THRESHOLD = int(os.getenv("JOIN_TEXT_ONLY_THRESHOLD", "50"))
+# Số giây sender chờ thêm để gom lời chào; 0 = chỉ gom những lời chào đã sẵn sàng
+JOIN_BATCH_WINDOW = float(os.getenv("JOIN_BATCH_WINDOW", "0"))
 
 # --- Khởi tạo biến toàn cục cho tài nguyên
 # SỬA LỖI: Load tài nguyên một lần duy nhất
 IMAGE_GEN_SEMAPHORE = None
+# Số lượt đang chờ / đang giữ IMAGE_GEN_SEMAPHORE (tự đếm, không đọc thuộc tính riêng của asyncio.Semaphore)
+RENDER_ACTIVITY = {'waiting': 0, 'running': 0}
 FONT_WELCOME = None
 FONT_NAME = None
 FONT_SYMBOL = None
 WELCOME_BG_IMG = None
-avatar_cache = {}
+RENDER_TEMPLATE = None
 CACHE_TTL = 900
+RENDER_EXECUTOR = None
+
+# --- Backend render ảnh chào mừng ---
+# "thread": chạy trong asyncio.to_thread; "process": chạy trong ProcessPoolExecutor (không bị GIL giới hạn)
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "thread").lower()
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+# Định dạng ảnh gửi lên Discord: "png", "png-rgb", "png-palette" hoặc "webp" (so sánh bằng `python bench.py encode`)
+WELCOME_IMAGE_FORMAT = os.getenv("WELCOME_IMAGE_FORMAT", "png").lower()
+WELCOME_IMAGE_EXTENSIONS = {"png": "png", "png-rgb": "png", "png-palette": "png", "webp": "webp"}
+WELCOME_PNG_COMPRESS_LEVEL = int(os.getenv("WELCOME_PNG_COMPRESS_LEVEL", "6"))
+WELCOME_WEBP_QUALITY = int(os.getenv("WELCOME_WEBP_QUALITY", "90"))
+# Số ảnh được render đồng thời (dùng chung cho lượt join và /testwelcome)
+IMAGE_GEN_CONCURRENCY = int(os.getenv("IMAGE_GEN_CONCURRENCY", "2"))
+# "numpy": gom màu nhanh trên avatar đã thu nhỏ; "colorthief": MMCQ của ColorThief như trước
+DOMINANT_COLOR_MODE = os.getenv("DOMINANT_COLOR_MODE", "numpy").lower()
+
+# --- Cache ghi nhớ màu và ảnh chào mừng đã render ---
+# Khóa theo hash avatar (asset.key); ảnh hoàn chỉnh khóa thêm theo tên hiển thị. Đặt 0 để tắt cache ảnh.
+WELCOME_COLOR_CACHE_BYTES = int(os.getenv("WELCOME_COLOR_CACHE_BYTES", str(256 * 1024)))
+WELCOME_CARD_CACHE_BYTES = int(os.getenv("WELCOME_CARD_CACHE_BYTES", str(8 * 1024 * 1024)))
+
+class LRUByteCache:
+    """Cache LRU giới hạn theo tổng số byte, có đếm hit/miss để theo dõi."""
+
+    def __init__(self, max_bytes, name="cache"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._data = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        return 256
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key, default=None):
+        """Như get nhưng không đếm hit/miss và không đổi thứ tự LRU (dùng cho render xem trước)."""
+        entry = self._data.get(key)
+        return default if entry is None else entry[0]
+
+    def put(self, key, value, size=None):
+        size = self._sizeof(value) if size is None else size
+        if size > self.max_bytes:
+            return False
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+        self._data[key] = (value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._data.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.current_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._data.clear()
+        self.current_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'name': self.name,
+            'entries': len(self._data),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+WELCOME_COLOR_CACHE = LRUByteCache(WELCOME_COLOR_CACHE_BYTES, name="welcome_colors")
+WELCOME_CARD_CACHE = LRUByteCache(WELCOME_CARD_CACHE_BYTES, name="welcome_cards")
+
+# --- Cache avatar ---
+# Giới hạn tổng byte của cache avatar; AVATAR_CACHE_STORE_DECODED=1 lưu sẵn avatar 210x210 RGBA đã giải mã thay vì file gốc
+AVATAR_CACHE_MAX_BYTES = int(os.getenv("AVATAR_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+AVATAR_CACHE_STORE_DECODED = os.getenv("AVATAR_CACHE_STORE_DECODED", "0") == "1"
+# Định dạng tĩnh yêu cầu từ CDN cho avatar không động ("webp", "png", "jpeg")
+AVATAR_CDN_FORMAT = os.getenv("AVATAR_CDN_FORMAT", "webp").lower()
+
+class AvatarCache(LRUByteCache):
+    """Cache avatar theo URL: LRU giới hạn byte, hết hạn sau `ttl` giây và gộp request
+    (nhiều lượt render cùng URL cùng lúc chỉ tải một lần)."""
+
+    def __init__(self, max_bytes, ttl, store_decoded=False, name="avatars"):
+        super().__init__(max_bytes, name=name)
+        self.ttl = ttl
+        self.store_decoded = store_decoded
+        self.coalesced = 0
+        self._inflight = {}
+
+    @staticmethod
+    def _sizeof(value):
+        data = value[0]
+        if isinstance(data, Image.Image):
+            return data.width * data.height * len(data.getbands())
+        return len(data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is not None and time.monotonic() - entry[0][1] >= self.ttl:
+            self.pop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0][0]
+
+    def peek(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or time.monotonic() - entry[0][1] >= self.ttl:
+            return default
+        return entry[0][0]
+
+    def sweep_expired(self):
+        now = time.monotonic()
+        expired = [k for k, (value, _) in self._data.items() if now - value[1] >= self.ttl]
+        for k in expired:
+            self.pop(k)
+        return len(expired)
+
+    async def fetch(self, url, downloader, trace=None, store=True):
+        """Trả về avatar (bytes gốc hoặc ảnh đã giải mã) cho `url`, tải bằng `downloader` nếu chưa có.
+        `store=False`: chỉ peek cache và không ghi bản vừa tải vào cache (render xem trước không được
+        đẩy avatar thật ra khỏi cache hay làm lệch số liệu hit/miss)."""
+        if not store:
+            data = self.peek(url)
+            if data is None:
+                try:
+                    data = await downloader(url)
+                except Exception as e:
+                    print(f"LỖI TẢI AVATAR: {e}")
+                    data = None
+            return data
+        data = self.get(url)
+        if data is not None:
+            print(f"DEBUG: Lấy avatar từ cache.")
+            if trace: trace.note("avatar_cache", "hit")
+            return data
+        inflight = self._inflight.get(url)
+        if inflight is not None:
+            self.coalesced += 1
+            if trace: trace.note("avatar_cache", "coalesced")
+            return await asyncio.shield(inflight)
+        if trace: trace.note("avatar_cache", "miss")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[url] = future
+        try:
+            data = await downloader(url)
+            if data and self.store_decoded:
+                data = await asyncio.to_thread(_decode_avatar, data, AVATAR_SIZE)
+            if data:
+                self.put(url, (data, time.monotonic()))
+        except Exception as e:
+            print(f"LỖI TẢI AVATAR: {e}")
+            data = None
+        finally:
+            self._inflight.pop(url, None)
+            future.set_result(data)
+        return data
+
+    def stats(self):
+        stats = super().stats()
+        stats['coalesced'] = self.coalesced
+        stats['inflight'] = len(self._inflight)
+        return stats
+
+avatar_cache = AvatarCache(AVATAR_CACHE_MAX_BYTES, CACHE_TTL, store_decoded=AVATAR_CACHE_STORE_DECODED)
+
+# --- Tầng cache trên đĩa (SQLite) dưới avatar_cache, giữ được qua các lần restart ---
+# Đặt AVATAR_DISK_CACHE_PATH (vd "avatar_cache.sqlite3") để bật. Khóa là asset.key (hash avatar của Discord),
+# lưu avatar đã resize về AVATAR_SIZE (PNG) và màu viền/bóng đã tính. WAL cho phép nhiều process đọc cùng lúc.
+AVATAR_DISK_CACHE_PATH = os.getenv("AVATAR_DISK_CACHE_PATH", "")
+AVATAR_DISK_CACHE_MAX_BYTES = int(os.getenv("AVATAR_DISK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+class AvatarDiskCache:
+    """Cache avatar + màu trong một file SQLite, giới hạn tổng dung lượng, bỏ bản truy cập lâu nhất trước.
+    Mọi hàm đều chặn (blocking), gọi qua asyncio.to_thread."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # key -> thời điểm đọc gần nhất, chưa ghi xuống đĩa; áp dụng ở lần put kế tiếp (trước khi dọn)
+        self._touches = {}
+        self._touches_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        # Tổng dung lượng cộng dồn khi ghi; chỉ SUM lại cả bảng lúc mở và lúc cần dọn
+        self.total_bytes = self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM avatars").fetchone()[0]
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Mỗi thread một connection; timeout chờ khi process khác đang ghi
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS avatars ("
+                "key TEXT PRIMARY KEY, avatar BLOB NOT NULL, colors TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS avatars_last_access ON avatars(last_access)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, record=True):
+        """Trả về (bytes avatar đã resize, colors) hoặc None. `record=False`: chỉ đọc, không đếm và không tính là lần truy cập."""
+        conn = self._connect()
+        row = conn.execute("SELECT avatar, colors FROM avatars WHERE key = ?", (key,)).fetchone()
+        if not record:
+            return None if row is None else (bytes(row[0]), {name: tuple(value) for name, value in json.loads(row[1]).items()})
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Không ghi gì trên đường đọc (ghi có thể phải chờ lock của thread / process khác tới `timeout` giây):
+        # chỉ nhớ lại, put() ghi gộp trước khi dọn nên thứ tự dọn vẫn theo lần đọc gần nhất
+        with self._touches_lock:
+            self._touches[key] = time.time()
+        colors = {name: tuple(value) for name, value in json.loads(row[1]).items()}
+        return bytes(row[0]), colors
+
+    def put(self, key, avatar_data, colors):
+        """Resize avatar về AVATAR_SIZE, lưu kèm màu, rồi dọn bớt nếu vượt max_bytes."""
+        buffer = io.BytesIO()
+        _decode_avatar(avatar_data, AVATAR_SIZE).save(buffer, format="PNG")
+        blob = buffer.getvalue()
+        colors_json = json.dumps({name: list(value) for name, value in colors.items()})
+        conn = self._connect()
+        with self._write_lock:
+            replaced = conn.execute("SELECT size FROM avatars WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO avatars (key, avatar, colors, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, colors_json, len(blob), time.time()),
+            )
+            self.total_bytes += len(blob) - (replaced[0] if replaced else 0)
+            self.writes += 1
+            self._apply_touches(conn)
+            if self.total_bytes > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _apply_touches(self, conn):
+        with self._touches_lock:
+            touches, self._touches = self._touches, {}
+        if touches:
+            conn.executemany("UPDATE avatars SET last_access = MAX(last_access, ?) WHERE key = ?",
+                             [(accessed, key) for key, accessed in touches.items()])
+
+    def _evict(self, conn):
+        # Đếm lại chính xác trước khi xóa: process khác dùng chung file có thể đã ghi / dọn
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM avatars").fetchone()[0]
+        self.total_bytes = total
+        if total <= self.max_bytes:
+            return
+        # Xóa tới khi còn 90% giới hạn để không phải dọn lại ở mỗi lần ghi
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM avatars ORDER BY last_access"):
+            doomed.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany("DELETE FROM avatars WHERE key = ?", doomed)
+        self.total_bytes = total - freed
+        self.evictions += len(doomed)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'bytes': self.total_bytes,
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+def _open_avatar_disk_cache():
+    if not AVATAR_DISK_CACHE_PATH:
+        return None
+    try:
+        cache = AvatarDiskCache(AVATAR_DISK_CACHE_PATH, AVATAR_DISK_CACHE_MAX_BYTES)
+        print(f"DEBUG: Cache avatar trên đĩa: {AVATAR_DISK_CACHE_PATH}")
+        return cache
+    except sqlite3.Error as e:
+        print(f"LỖI CACHE ĐĨA: Không mở được {AVATAR_DISK_CACHE_PATH}, chỉ dùng cache RAM: {e}")
+        return None
+
+avatar_disk_cache = _open_avatar_disk_cache()
+_DISK_CACHE_WRITES = set()
+
+async def disk_cache_lookup(key, trace=None, record=True):
+    """(avatar, colors) từ cache đĩa, hoặc None nếu tắt / không có / lỗi."""
+    if avatar_disk_cache is None:
+        return None
+    try:
+        found = await asyncio.to_thread(avatar_disk_cache.get, key, record)
+    except Exception as e:
+        print(f"LỖI CACHE ĐĨA: {e}")
+        return None
+    if trace: trace.note("disk_cache", "hit" if found else "miss")
+    return found
+
+def disk_cache_store_later(key, avatar_data, colors):
+    """Ghi vào cache đĩa ở nền (resize + encode + ghi SQLite), không làm chậm lượt chào đang chạy."""
+    if avatar_disk_cache is None:
+        return
+
+    async def _store():
+        try:
+            await asyncio.to_thread(avatar_disk_cache.put, key, avatar_data, colors)
+        except Exception as e:
+            print(f"LỖI CACHE ĐĨA: Không ghi được {key}: {e}")
+
+    task = asyncio.create_task(_store())
+    _DISK_CACHE_WRITES.add(task)
+    task.add_done_callback(_DISK_CACHE_WRITES.discard)
+
+def welcome_cache_stats():
+    """Số liệu hit/miss của cache avatar, cache màu và cache ảnh chào mừng."""
+    return {cache.name: cache.stats() for cache in (avatar_cache, WELCOME_COLOR_CACHE, WELCOME_CARD_CACHE)}
 
 # --- CÁC HẰNG SỐ DÙNG TRONG TẠO ẢNH ---
 FONT_MAIN_PATH = "1FTV-Designer.otf"
@@ -72,6 +630,142 @@ DEFAULT_IMAGE_DIMENSIONS = (872, 430)
 LINE_THICKNESS = 3
 LINE_VERTICAL_OFFSET_FROM_NAME = 13
 LINE_LENGTH_FACTOR = 0.70
+WELCOME_TEXT = "WELCOME"
+STROKE_THICKNESS = 6
+STROKE_GAP_SIZE = 5
+SUPERSAMPLE_FACTOR = 4
+DOMINANT_COLOR_SAMPLE_SIZE = 64
+DOMINANT_COLOR_BUCKET_BITS = 4
+DOMINANT_COLOR_MIN_SHARE = 0.01
+
+# --- Đo thời gian từng bước của pipeline chào mừng ---
+# Trace có tổng thời gian >= WELCOME_TRACE_SLOW_MS được in ra log; đặt WELCOME_TRACE_LOG để ghi thêm vào file (JSON lines)
+WELCOME_TRACE_SLOW_MS = float(os.getenv("WELCOME_TRACE_SLOW_MS", "3000"))
+WELCOME_TRACE_LOG = os.getenv("WELCOME_TRACE_LOG")
+HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+class StageHistogram:
+    """Histogram thời gian (ms) theo bucket cố định, kiểu Prometheus."""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value_ms):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value_ms <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value_ms
+        self.max = max(self.max, value_ms)
+
+    def quantile(self, q):
+        """Ước lượng phân vị theo cận trên của bucket."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, bound in enumerate(self.buckets):
+            cumulative += self.counts[i]
+            if cumulative >= target:
+                return float(bound)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum_ms': self.sum,
+            'max_ms': self.max,
+            'p50_ms': self.quantile(0.50),
+            'p95_ms': self.quantile(0.95),
+            'buckets': list(zip(self.buckets, self.counts)),
+            'overflow': self.counts[-1],
+        }
+
+STAGE_HISTOGRAMS = {}
+TRACE_COUNTERS = {}
+
+def observe_stage(name, value_ms):
+    histogram = STAGE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = STAGE_HISTOGRAMS[name] = StageHistogram()
+    histogram.observe(value_ms)
+
+def count_event(name, amount=1):
+    TRACE_COUNTERS[name] = TRACE_COUNTERS.get(name, 0) + amount
+
+class WelcomeTrace:
+    """Ghi thời gian từng bước của một lượt tạo/gửi ảnh chào mừng.
+    Trong process render chỉ gom số liệu; histogram được cập nhật khi `finish()` ở process chính."""
+
+    def __init__(self, label="", started=None, metrics=True):
+        # `started` (perf_counter) cho phép tính cả thời gian chờ trước khi trace được tạo, ví dụ thời gian nằm trong hàng đợi
+        # `metrics=False`: chỉ gom số liệu cho người gọi, không đưa vào histogram / bộ đếm của /metrics (vd render xem trước)
+        self.label = label
+        self.metrics = metrics
+        self.started = time.perf_counter() if started is None else started
+        self.stages = {}
+        self.notes = {}
+        self.finished = False
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - t0) * 1000)
+
+    def record(self, name, value_ms):
+        self.stages[name] = self.stages.get(name, 0.0) + value_ms
+
+    def merge(self, stages):
+        for name, value_ms in (stages or {}).items():
+            self.record(name, value_ms)
+
+    def note(self, key, value):
+        self.notes[key] = value
+        if self.metrics:
+            count_event(f"{key}_{value}")
+
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        if error is not None:
+            self.note("error", type(error).__name__)
+        if not self.metrics:
+            return
+        total_ms = (time.perf_counter() - self.started) * 1000
+        for name, value_ms in self.stages.items():
+            observe_stage(name, value_ms)
+        observe_stage("total", total_ms)
+        if total_ms >= WELCOME_TRACE_SLOW_MS:
+            self._dump_slow(total_ms)
+
+    def _dump_slow(self, total_ms):
+        stages = ", ".join(f"{k}={v:.0f}ms" for k, v in sorted(self.stages.items(), key=lambda kv: -kv[1]))
+        print(f"TRACE CHẬM: {self.label} mất {total_ms:.0f}ms ({stages}) {self.notes}")
+        if WELCOME_TRACE_LOG:
+            try:
+                with open(WELCOME_TRACE_LOG, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({'time': time.time(), 'label': self.label, 'total_ms': total_ms,
+                                        'stages': self.stages, 'notes': self.notes}, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"LỖI TRACE: Không ghi được trace chậm vào {WELCOME_TRACE_LOG}: {e}")
+
+def welcome_trace_stats():
+    """Histogram thời gian từng bước và bộ đếm cache hit/miss."""
+    return {
+        'stages': {name: histogram.snapshot() for name, histogram in STAGE_HISTOGRAMS.items()},
+        'counters': dict(TRACE_COUNTERS),
+    }
 
 # --- Các hàm xử lý màu sắc và tạo ảnh ---
 def rgb_to_hsl(r, g, b):
@@ -110,14 +804,11 @@ def adjust_color_brightness_saturation(rgb_color, brightness_factor=1.0, saturat
     s = min(1.0, max(0.0, s * saturation_factor))
     return hsl_to_rgb(h, s, l)
 
-async def get_dominant_color(image_bytes, color_count=20):
-    """SỬA LỖI: Dùng asyncio.to_thread để không block event loop."""
+def _extract_dominant_color_colorthief(image_bytes, color_count=20):
+    """Chế độ cũ: lượng tử hóa MMCQ của ColorThief trên ảnh gốc (chậm với avatar 1024px)."""
     try:
-        def blocking_extract_palette(img_bytes, color_count):
-            f = io.BytesIO(img_bytes)
-            color_thief = ColorThief(f)
-            return color_thief.get_palette(color_count=color_count, quality=1)
-        palette = await asyncio.to_thread(blocking_extract_palette, image_bytes, color_count)
+        color_thief = ColorThief(io.BytesIO(image_bytes))
+        palette = color_thief.get_palette(color_count=color_count, quality=1)
         qualified_colors = []
         def get_hue_priority_index(h_value):
             if 0.75 <= h_value < 0.95: return 0
@@ -155,107 +846,303 @@ async def get_dominant_color(image_bytes, color_count=20):
         print(f"LỖI COLORTHIEF: Không thể lấy bảng màu từ avatar: {e}")
         return (0, 252, 233)
 
-def _load_fonts(main_path, symbol_path):
+def _hsl_arrays(rgb):
+    """Phiên bản vector hóa của rgb_to_hsl cho mảng (N, 3) giá trị 0-255."""
+    rgbf = rgb.astype(np.float64) / 255.0
+    r, g, b = rgbf[:, 0], rgbf[:, 1], rgbf[:, 2]
+    cmax, cmin = rgbf.max(axis=1), rgbf.min(axis=1)
+    delta = cmax - cmin
+    l = (cmax + cmin) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(l < 0.5, delta / (cmax + cmin), delta / (2 - cmax - cmin))
+        h = np.where(cmax == r, ((g - b) / delta) % 6,
+                     np.where(cmax == g, (b - r) / delta + 2, (r - g) / delta + 4)) / 6
+    s = np.where(delta == 0, 0.0, s)
+    h = np.where(delta == 0, 0.0, h)
+    return h, s, l
+
+def _pick_palette_color_numpy(palette):
+    """Áp dụng đúng các luật chấm điểm HSL của _extract_dominant_color_colorthief, nhưng vector hóa."""
+    h, s, l = _hsl_arrays(palette)
+    skipped = ((l < 0.5) & (s < 0.25)) | (l > 0.80)
+    is_vibrant_and_bright = ~skipped & (l >= 0.5) & (s > 0.4)
+    is_bright_grayish = ~skipped & ~is_vibrant_and_bright & (l >= 0.6) & (s >= 0.25) & (s <= 0.4)
+    qualified = np.flatnonzero(is_vibrant_and_bright | is_bright_grayish)
+    if qualified.size:
+        hue_priority = np.select(
+            [(h >= 0.75) & (h < 0.95), (h >= 0.40) & (h < 0.75), (h >= 0.18) & (h < 0.40)], [0, 1, 2], default=3)
+        hue_priority = np.where(is_vibrant_and_bright, hue_priority, 98)
+        score = np.where(is_vibrant_and_bright, s * l, l * 0.5 + s * 0.5)
+        type_order = np.where(is_vibrant_and_bright, 0, 1)
+        order = np.lexsort((hue_priority[qualified], -score[qualified], type_order[qualified]))
+        return tuple(int(c) for c in palette[qualified[order[0]]])
+    not_dark = ~np.all(palette < 30, axis=1)
+    if not not_dark.any():
+        return (0, 252, 233)
+    candidates = np.flatnonzero(not_dark)
+    return tuple(int(c) for c in palette[candidates[np.argmax(l[candidates])]])
+
+def _extract_dominant_color_numpy(avatar_img, color_count=20):
+    """Chế độ nhanh: gom màu theo bucket bằng NumPy trên bản thu nhỏ của avatar đã giải mã."""
+    try:
+        sample = avatar_img.convert('RGBA').resize((DOMINANT_COLOR_SAMPLE_SIZE, DOMINANT_COLOR_SAMPLE_SIZE), Image.NEAREST)
+        pixels = np.asarray(sample, dtype=np.uint8).reshape(-1, 4)
+        # Giống ColorThief: bỏ pixel trong suốt và pixel gần như trắng
+        keep = (pixels[:, 3] >= 125) & ~np.all(pixels[:, :3] > 250, axis=1)
+        rgb = pixels[keep, :3]
+        if rgb.size == 0:
+            return (0, 252, 233)
+        shift = 8 - DOMINANT_COLOR_BUCKET_BITS
+        q = (rgb >> shift).astype(np.int64)
+        bucket_ids = (q[:, 0] << (2 * DOMINANT_COLOR_BUCKET_BITS)) | (q[:, 1] << DOMINANT_COLOR_BUCKET_BITS) | q[:, 2]
+        n_buckets = 1 << (3 * DOMINANT_COLOR_BUCKET_BITS)
+        counts = np.bincount(bucket_ids, minlength=n_buckets)
+        top = np.argsort(counts, kind='stable')[::-1][:color_count]
+        # Bỏ các bucket quá ít pixel (thường là viền pha trộn sau khi resize), giống MMCQ ưu tiên vùng đông pixel
+        min_count = max(1, int(rgb.shape[0] * DOMINANT_COLOR_MIN_SHARE))
+        top = top[counts[top] >= min_count] if (counts[top] >= min_count).any() else top[counts[top] > 0]
+        sums = np.stack([np.bincount(bucket_ids, weights=rgb[:, c], minlength=n_buckets)[top] for c in range(3)], axis=1)
+        palette = (sums / counts[top, None]).astype(np.int64)
+        return _pick_palette_color_numpy(palette)
+    except Exception as e:
+        print(f"LỖI NUMPY COLOR: Không thể lấy màu chủ đạo từ avatar: {e}")
+        return (0, 252, 233)
+
+def _extract_dominant_color(image_bytes, color_count=20, avatar_img=None, mode=None):
+    """Chạy đồng bộ: gọi trong thread hoặc trong process render, không gọi trực tiếp trên event loop."""
+    mode = mode or DOMINANT_COLOR_MODE
+    if mode == "numpy":
+        if avatar_img is None:
+            avatar_img = _decode_avatar(image_bytes, AVATAR_SIZE)
+        return _extract_dominant_color_numpy(avatar_img, color_count)
+    if isinstance(image_bytes, Image.Image):
+        # Cache đang lưu avatar đã giải mã: encode lại bản nhỏ cho ColorThief
+        buf = io.BytesIO()
+        image_bytes.save(buf, format='PNG')
+        image_bytes = buf.getvalue()
+    return _extract_dominant_color_colorthief(image_bytes, color_count)
+
+async def get_dominant_color(image_bytes, color_count=20, mode=None):
+    """SỬA LỖI: Dùng asyncio.to_thread để không block event loop."""
+    return await asyncio.to_thread(_extract_dominant_color, image_bytes, color_count, None, mode)
+
+def _open_fonts(main_path, symbol_path):
     # Sửa lỗi: Cải thiện logic tải font
-    global FONT_WELCOME, FONT_NAME, FONT_SYMBOL
     try:
-        FONT_WELCOME = ImageFont.truetype(main_path, WELCOME_FONT_SIZE)
-        FONT_NAME = ImageFont.truetype(main_path, NAME_FONT_SIZE)
+        font_welcome = ImageFont.truetype(main_path, WELCOME_FONT_SIZE)
+        font_name = ImageFont.truetype(main_path, NAME_FONT_SIZE)
         print(f"DEBUG: Đã tải font chính thành công: {main_path}")
     except Exception as e:
         print(f"LỖI FONT: Không thể tải font chính '{main_path}'. Sử dụng Arial. Chi tiết: {e}")
         try:
-            FONT_WELCOME = ImageFont.truetype("arial.ttf", WELCOME_FONT_SIZE)
-            FONT_NAME = ImageFont.truetype("arial.ttf", NAME_FONT_SIZE)
+            font_welcome = ImageFont.truetype("arial.ttf", WELCOME_FONT_SIZE)
+            font_name = ImageFont.truetype("arial.ttf", NAME_FONT_SIZE)
             print("DEBUG: Đã sử dụng font Arial.ttf cho văn bản chính.")
         except Exception:
-            FONT_WELCOME = ImageFont.load_default().font_variant(size=WELCOME_FONT_SIZE)
-            FONT_NAME = ImageFont.load_default().font_variant(size=NAME_FONT_SIZE)
+            font_welcome = ImageFont.load_default().font_variant(size=WELCOME_FONT_SIZE)
+            font_name = ImageFont.load_default().font_variant(size=NAME_FONT_SIZE)
             print("DEBUG: Đã sử dụng font mặc định của Pillow cho văn bản chính.")
     try:
-        FONT_SYMBOL = ImageFont.truetype(symbol_path, NAME_FONT_SIZE)
+        font_symbol = ImageFont.truetype(symbol_path, NAME_FONT_SIZE)
         print(f"DEBUG: Đã tải font biểu tượng thành công: {symbol_path}")
     except Exception as e:
         print(f"LỖI FONT: Không thể tải font biểu tượng '{symbol_path}'. Sử dụng font mặc định cho biểu tượng. Chi tiết: {e}")
-        FONT_SYMBOL = ImageFont.load_default().font_variant(size=NAME_FONT_SIZE)
+        font_symbol = ImageFont.load_default().font_variant(size=NAME_FONT_SIZE)
         print("DEBUG: Đã sử dụng font mặc định của Pillow cho biểu tượng.")
+    return font_welcome, font_name, font_symbol
+
+def _load_fonts(main_path, symbol_path):
+    global FONT_WELCOME, FONT_NAME, FONT_SYMBOL
+    FONT_WELCOME, FONT_NAME, FONT_SYMBOL = _open_fonts(main_path, symbol_path)
     return FONT_WELCOME, FONT_NAME, FONT_SYMBOL
 
-def _load_background_image(path, default_dims):
+def _open_background_image(path, default_dims):
     # Sửa lỗi: Cải thiện logic tải ảnh nền
-    global WELCOME_BG_IMG
     try:
-        WELCOME_BG_IMG = Image.open(path).convert("RGBA")
-        print(f"DEBUG: Đã tải ảnh nền: {path} với kích thước {WELCOME_BG_IMG.size[0]}x{WELCOME_BG_IMG.size[1]}")
+        bg_img = Image.open(path).convert("RGBA")
+        print(f"DEBUG: Đã tải ảnh nền: {path} với kích thước {bg_img.size[0]}x{bg_img.size[1]}")
     except FileNotFoundError:
         print(f"LỖI ẢNH NỀN: Không tìm thấy ảnh nền '{path}'. Sử dụng nền màu mặc định.")
-        WELCOME_BG_IMG = Image.new('RGBA', default_dims, color=(0, 0, 0, 255))
+        bg_img = Image.new('RGBA', default_dims, color=(0, 0, 0, 255))
     except Exception as e:
         print(f"LỖI ẢNH NỀN: Lỗi khi mở ảnh nền: {e}. Sử dụng nền màu mặc định.")
-        WELCOME_BG_IMG = Image.new('RGBA', default_dims, color=(0, 0, 0, 255))
+        bg_img = Image.new('RGBA', default_dims, color=(0, 0, 0, 255))
+    return bg_img
+
+def _load_background_image(path, default_dims):
+    global WELCOME_BG_IMG
+    WELCOME_BG_IMG = _open_background_image(path, default_dims)
     return WELCOME_BG_IMG
 
-async def _get_and_process_avatar(member_avatar_url, avatar_size, cache):
-    avatar_bytes = None
-    # Kiểm tra cache
-    if member_avatar_url in cache and (asyncio.get_event_loop().time() - cache[member_avatar_url]['timestamp']) < CACHE_TTL:
-        avatar_bytes = cache[member_avatar_url]['data']
-        print(f"DEBUG: Lấy avatar từ cache.")
-    else:
-        # Dùng session dùng chung để tải ảnh (Tối ưu ở đây)
+async def _download_avatar(url):
+    # Dùng session dùng chung để tải ảnh (Tối ưu ở đây)
+    async with bot.session.get(str(url)) as resp:
+        if resp.status == 200:
+            return await resp.read()
+        print(f"LỖI TẢI AVATAR: HTTP {resp.status} cho {url}")
+    return None
+
+def _cdn_avatar_size(avatar_size):
+    # CDN Discord chỉ nhận size là lũy thừa của 2 trong khoảng 16-4096
+    return min(4096, 1 << max(4, (avatar_size - 1).bit_length()))
+
+def _avatar_fetch_urls(member, avatar_size):
+    """URL avatar theo thứ tự ưu tiên: bản nhỏ nhất đủ phủ `avatar_size` ở định dạng tĩnh
+    (avatar động chỉ lấy frame đầu dạng PNG), sau đó là URL gốc để dự phòng."""
+    if not member.avatar:
+        return [str(member.default_avatar.url)]
+    original_url = str(member.avatar.url)
+    try:
+        sized_url = str(member.avatar.replace(size=_cdn_avatar_size(avatar_size), format="png", static_format=AVATAR_CDN_FORMAT).url)
+    except ValueError as e:
+        print(f"LỖI URL AVATAR: Không tạo được URL thu nhỏ, dùng URL gốc: {e}")
+        return [original_url]
+    return [sized_url] if sized_url == original_url else [sized_url, original_url]
+
+async def _get_and_process_avatar(avatar_urls, cache, trace=None, store=True):
+    """Chỉ tải avatar (có cache, gộp request trùng URL), thử lần lượt từng URL cho tới khi thành công.
+    Giải mã và resize được làm trong backend render, trừ khi cache đang lưu sẵn avatar đã giải mã."""
+    if isinstance(avatar_urls, str):
+        avatar_urls = [avatar_urls]
+    for url in avatar_urls:
+        avatar_data = await cache.fetch(str(url), _download_avatar, trace, store)
+        if avatar_data:
+            return avatar_data
+        print(f"DEBUG: Không tải được avatar từ {url}, thử URL tiếp theo.")
+    return None
+
+def _decode_avatar(avatar_data, avatar_size):
+    """`avatar_data` là bytes ảnh gốc hoặc ảnh PIL đã giải mã sẵn (từ cache)."""
+    if isinstance(avatar_data, Image.Image):
+        if avatar_data.size == (avatar_size, avatar_size) and avatar_data.mode == "RGBA":
+            return avatar_data
+        return avatar_data.convert("RGBA").resize((avatar_size, avatar_size), Image.LANCZOS)
+    avatar_img = None
+    if avatar_data:
         try:
-            async with bot.session.get(str(member_avatar_url)) as resp:
-                if resp.status == 200:
-                    avatar_bytes = await resp.read()
-                    cache[member_avatar_url] = {'data': avatar_bytes, 'timestamp': asyncio.get_event_loop().time()}
+            avatar_img = Image.open(io.BytesIO(avatar_data))
+            # Ảnh động (GIF/WebP) chỉ giải mã frame đầu; JPEG lớn thì để libjpeg giải mã thẳng ở tỉ lệ nhỏ
+            avatar_img.seek(0)
+            avatar_img.draft("RGB", (avatar_size, avatar_size))
+            avatar_img = avatar_img.convert("RGBA")
         except Exception as e:
-            print(f"LỖI TẢI AVATAR: {e}")
-
-    if avatar_bytes:
-        data = io.BytesIO(avatar_bytes)
-        avatar_img = Image.open(data).convert("RGBA")
-    else:
+            print(f"LỖI GIẢI MÃ AVATAR: {e}")
+            avatar_img = None
+    if avatar_img is None:
         avatar_img = Image.new('RGBA', (avatar_size, avatar_size), color=(100, 100, 100, 255))
-    
-    avatar_img = avatar_img.resize((avatar_size, avatar_size), Image.LANCZOS)
-    return avatar_img, avatar_bytes
+    return avatar_img.resize((avatar_size, avatar_size), Image.LANCZOS)
 
-def _draw_circular_avatar_and_stroke(img, avatar_img, avatar_x, avatar_y, avatar_size, stroke_color_rgb):
-    draw = ImageDraw.Draw(img)
-    blur_color_with_alpha = (*stroke_color_rgb, 128)
-    blur_bg_raw_circle = Image.new('RGBA', (AVATAR_SIZE, AVATAR_SIZE), (0, 0, 0, 0))
-    draw_blur_bg_raw = ImageDraw.Draw(blur_bg_raw_circle)
-    draw_blur_bg_raw.ellipse((0, 0, AVATAR_SIZE, AVATAR_SIZE), fill=blur_color_with_alpha)
-    img.paste(blur_bg_raw_circle, (avatar_x, avatar_y), blur_bg_raw_circle)
-    stroke_thickness = 6
-    gap_size = 5
-    outer_stroke_diameter = AVATAR_SIZE + (gap_size * 2) + (stroke_thickness * 2)
-    inner_stroke_diameter = AVATAR_SIZE + (gap_size * 2)
-    supersample_factor = 4
-    temp_stroke_layer_supersampled = Image.new('RGBA', (outer_stroke_diameter * supersample_factor, outer_stroke_diameter * supersample_factor), (0, 0, 0, 0))
-    draw_temp_stroke = ImageDraw.Draw(temp_stroke_layer_supersampled)
-    draw_temp_stroke.ellipse((0, 0, outer_stroke_diameter * supersample_factor, outer_stroke_diameter * supersample_factor), fill=(*stroke_color_rgb, 255))
-    inner_offset_x = (outer_stroke_diameter * supersample_factor - inner_stroke_diameter * supersample_factor) // 2
-    inner_offset_y = (outer_stroke_diameter * supersample_factor - inner_stroke_diameter * supersample_factor) // 2
-    draw_temp_stroke.ellipse((inner_offset_x, inner_offset_y, inner_offset_x + inner_stroke_diameter * supersample_factor, inner_offset_y + inner_stroke_diameter * supersample_factor), fill=(0, 0, 0, 0))
-    stroke_final_image = temp_stroke_layer_supersampled.resize((outer_stroke_diameter, outer_stroke_diameter), Image.LANCZOS)
-    stroke_paste_x = avatar_x - gap_size - stroke_thickness
-    stroke_paste_y = avatar_y - gap_size - stroke_thickness
-    img.paste(stroke_final_image, (stroke_paste_x, stroke_paste_y), stroke_final_image)
-    avatar_layer = Image.new('RGBA', (AVATAR_SIZE, AVATAR_SIZE), (0, 0, 0, 0))
-    avatar_layer.paste(avatar_img, (0, 0))
-    mask_supersample_factor = 4
-    mask_raw_size = AVATAR_SIZE * mask_supersample_factor
+def _build_render_template(bg_img=None, font_welcome=None, font_name=None):
+    """Dựng sẵn các lớp tĩnh (nền, mask vòng viền, mask tròn, vị trí chữ) một lần duy nhất.
+    Mỗi lần có member join chỉ còn tô màu, dán avatar và vẽ tên."""
+    global RENDER_TEMPLATE
+    if FONT_WELCOME is None or FONT_NAME is None or FONT_SYMBOL is None:
+        _load_fonts(FONT_MAIN_PATH, FONT_SYMBOL_PATH)
+    if WELCOME_BG_IMG is None:
+        _load_background_image(BACKGROUND_IMAGE_PATH, DEFAULT_IMAGE_DIMENSIONS)
+    fonts = (font_welcome or FONT_WELCOME, font_name or FONT_NAME, FONT_SYMBOL)
+    RENDER_TEMPLATE = _make_render_template(bg_img or WELCOME_BG_IMG, fonts)
+    print("DEBUG: Đã dựng sẵn template ảnh chào mừng.")
+    return RENDER_TEMPLATE
+
+def _make_render_template(bg_img, fonts):
+    """Các lớp tĩnh của một kiểu ảnh (nền + bộ font), dùng chung cho template mặc định và template từng server."""
+    font_welcome, font_name, _ = fonts
+    img_width, img_height = bg_img.size
+    temp_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+    # Mask nền mờ sau avatar (ellipse không khử răng cưa, alpha 128 như bản gốc)
+    blur_circle_mask = Image.new('L', (AVATAR_SIZE, AVATAR_SIZE), 0)
+    ImageDraw.Draw(blur_circle_mask).ellipse((0, 0, AVATAR_SIZE, AVATAR_SIZE), fill=128)
+
+    # Mask vòng viền: vẽ supersample 4x rồi thu nhỏ LANCZOS, chỉ giữ kênh alpha để tô màu sau
+    outer_stroke_diameter = AVATAR_SIZE + (STROKE_GAP_SIZE * 2) + (STROKE_THICKNESS * 2)
+    inner_stroke_diameter = AVATAR_SIZE + (STROKE_GAP_SIZE * 2)
+    outer_raw = outer_stroke_diameter * SUPERSAMPLE_FACTOR
+    inner_raw = inner_stroke_diameter * SUPERSAMPLE_FACTOR
+    ring_raw = Image.new('L', (outer_raw, outer_raw), 0)
+    draw_ring_raw = ImageDraw.Draw(ring_raw)
+    draw_ring_raw.ellipse((0, 0, outer_raw, outer_raw), fill=255)
+    inner_offset = (outer_raw - inner_raw) // 2
+    draw_ring_raw.ellipse((inner_offset, inner_offset, inner_offset + inner_raw, inner_offset + inner_raw), fill=0)
+    ring_mask = ring_raw.resize((outer_stroke_diameter, outer_stroke_diameter), Image.LANCZOS)
+
+    # Mask tròn cho avatar (supersample 4x)
+    mask_raw_size = AVATAR_SIZE * SUPERSAMPLE_FACTOR
     circular_mask_raw = Image.new('L', (mask_raw_size, mask_raw_size), 0)
-    draw_circular_mask_raw = ImageDraw.Draw(circular_mask_raw)
-    draw_circular_mask_raw.ellipse((0, 0, mask_raw_size, mask_raw_size), fill=255)
-    circular_mask_smoothed = circular_mask_raw.resize((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
-    try:
-        original_alpha = avatar_layer.split()[3]
-    except ValueError:
-        original_alpha = Image.new('L', circular_mask_smoothed.size, 255)
-    final_alpha_mask = Image.composite(circular_mask_smoothed, Image.new('L', circular_mask_smoothed.size, 0), original_alpha)
-    img.paste(avatar_layer, (avatar_x, avatar_y), final_alpha_mask)
+    ImageDraw.Draw(circular_mask_raw).ellipse((0, 0, mask_raw_size, mask_raw_size), fill=255)
+    circle_mask = circular_mask_raw.resize((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
+
+    # Vị trí avatar và chữ "WELCOME" không phụ thuộc member
+    avatar_x = img_width // 2 - AVATAR_SIZE // 2
+    avatar_y = int(img_height * 0.36) - AVATAR_SIZE // 2
+    y_offset_from_avatar = 20
+    welcome_text_y = avatar_y + AVATAR_SIZE + y_offset_from_avatar
+    welcome_text_width = temp_draw.textlength(WELCOME_TEXT, font=font_welcome)
+    welcome_bbox = temp_draw.textbbox((0, 0), WELCOME_TEXT, font=font_welcome)
+    welcome_actual_height = welcome_bbox[3] - welcome_bbox[1]
+
+    return {
+        'background': bg_img,
+        'fonts': fonts,
+        'size': (img_width, img_height),
+        'shadow_offset': (int(img_width * 0.005), int(img_height * 0.005)),
+        'blur_circle_mask': blur_circle_mask,
+        'ring_mask': ring_mask,
+        'ring_offset': STROKE_GAP_SIZE + STROKE_THICKNESS,
+        'circle_mask': circle_mask,
+        'avatar_pos': (avatar_x, avatar_y),
+        'welcome_text_pos': ((img_width - welcome_text_width) / 2, welcome_text_y),
+        'name_text_y': welcome_text_y + welcome_actual_height + 20,
+        'name_actual_height': _get_text_height("M", font_name, temp_draw),
+    }
+
+# Template của các server có nền / font riêng: LRU giới hạn số lượng để RAM không tăng theo số server
+GUILD_TEMPLATE_CACHE_SIZE = int(os.getenv("GUILD_TEMPLATE_CACHE_SIZE", "8"))
+_GUILD_TEMPLATES = OrderedDict()
+# Thread render và event loop (GuildConfigStore.load) cùng sửa LRU này
+_GUILD_TEMPLATES_LOCK = threading.Lock()
+
+def _render_template_for(style=None):
+    """Template cho `style` = (ảnh nền, font chính, font biểu tượng, lần tải config); None là kiểu mặc định.
+    Lần tải config nằm trong khóa nên template cũ (kể cả trong các process render) tự hết dùng sau khi reload."""
+    if style is None:
+        return RENDER_TEMPLATE or _build_render_template()
+    with _GUILD_TEMPLATES_LOCK:
+        template = _GUILD_TEMPLATES.get(style)
+        if template is not None:
+            _GUILD_TEMPLATES.move_to_end(style)
+            return template
+    background_path, font_main_path, font_symbol_path, _ = style
+    # Dựng ngoài lock (đọc file ảnh / font); hai thread cùng dựng một kiểu thì bản sau ghi đè, vô hại
+    template = _make_render_template(_open_background_image(background_path, DEFAULT_IMAGE_DIMENSIONS),
+                                     _open_fonts(font_main_path, font_symbol_path))
+    with _GUILD_TEMPLATES_LOCK:
+        _GUILD_TEMPLATES[style] = template
+        while len(_GUILD_TEMPLATES) > GUILD_TEMPLATE_CACHE_SIZE:
+            _GUILD_TEMPLATES.popitem(last=False)
+    print(f"DEBUG: Đã dựng template ảnh chào mừng cho kiểu {style}.")
+    return template
+
+def _tint_mask(mask, color_rgb):
+    layer = Image.new('RGBA', mask.size, (*color_rgb, 255))
+    layer.putalpha(mask)
+    return layer
+
+def _draw_circular_avatar_and_stroke(img, avatar_img, avatar_x, avatar_y, avatar_size, stroke_color_rgb, template=None):
+    template = template or RENDER_TEMPLATE or _build_render_template()
+    blur_mask = template['blur_circle_mask']
+    img.paste((*stroke_color_rgb, 128), (avatar_x, avatar_y, avatar_x + blur_mask.width, avatar_y + blur_mask.height), blur_mask)
+    stroke_final_image = _tint_mask(template['ring_mask'], stroke_color_rgb)
+    stroke_paste_x = avatar_x - template['ring_offset']
+    stroke_paste_y = avatar_y - template['ring_offset']
+    img.paste(stroke_final_image, (stroke_paste_x, stroke_paste_y), stroke_final_image)
+    circular_mask_smoothed = template['circle_mask']
+    if avatar_img.mode == 'RGBA':
+        final_alpha_mask = ImageChops.multiply(circular_mask_smoothed, avatar_img.getchannel('A'))
+    else:
+        final_alpha_mask = circular_mask_smoothed
+    img.paste(avatar_img, (avatar_x, avatar_y), final_alpha_mask)
 
 def _draw_text_with_shadow(draw_obj, text, font, x, y, main_color, shadow_color, offset_x, offset_y):
     draw_obj.text((x + offset_x, y + offset_y), text, font=font, fill=shadow_color)
@@ -282,86 +1169,933 @@ def is_basic_char(char):
     if (0x00C0 <= unicode_ord <= 0x017F) or (0x1EA0 <= unicode_ord <= 0x1EFF): return True
     return False
 
+# Cache độ rộng glyph theo (font, ký tự); font được tải một lần nên cache không phình theo số member
+_GLYPH_ADVANCE_CACHE = {}
+
+def _font_cache_key(font):
+    path = getattr(font, 'path', None)
+    if isinstance(path, str):
+        return (path, getattr(font, 'size', None))
+    return id(font)
+
+def _glyph_advance(char, font):
+    key = (_font_cache_key(font), char)
+    advance = _GLYPH_ADVANCE_CACHE.get(key)
+    if advance is None:
+        advance = font.getlength(char)
+        _GLYPH_ADVANCE_CACHE[key] = advance
+    return advance
+
 def process_text_for_drawing(original_text, main_font, symbol_font, replacement_char='✦'):
-    processed_parts = []
+    """Chia tên thành các đoạn liên tiếp cùng font (font chính / ký tự thay thế bằng FONT_SYMBOL).
+    Trả về ([(đoạn chữ, font, vị trí x tương đối)], tổng độ rộng) để vẽ bóng, chữ và gạch trang trí
+    dùng chung một lần tính layout, mỗi đoạn chỉ một lệnh draw.text."""
+    runs = []
     total_width = 0
-    temp_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    run_chars, run_font, run_x = [], None, 0
     for char in original_text:
         if is_basic_char(char):
-            processed_parts.append((char, main_font))
-            total_width += temp_draw.textlength(char, font=main_font)
+            glyph, font = char, main_font
         else:
-            processed_parts.append((replacement_char, symbol_font))
-            total_width += temp_draw.textlength(replacement_char, font=symbol_font)
-    return processed_parts, total_width
+            glyph, font = replacement_char, symbol_font
+        if font is not run_font and run_chars:
+            runs.append((''.join(run_chars), run_font, run_x))
+            run_chars, run_x = [], total_width
+        run_chars.append(glyph)
+        run_font = font
+        total_width += _glyph_advance(glyph, font)
+    if run_chars:
+        runs.append((''.join(run_chars), run_font, run_x))
+    return runs, total_width
 
-async def create_welcome_image(member):
-    # SỬA LỖI: Không tải lại tài nguyên. Dùng biến toàn cục đã tải trong on_ready
-    global FONT_WELCOME, FONT_NAME, FONT_SYMBOL, WELCOME_BG_IMG
-    
-    img = WELCOME_BG_IMG.copy()
-    img_width, img_height = img.size
+def _derive_welcome_colors(dominant_color):
+    """Màu viền và màu bóng chữ suy ra từ màu chủ đạo của avatar."""
+    return {
+        'stroke': adjust_color_brightness_saturation(
+            dominant_color, brightness_factor=1.1, saturation_factor=4.9, clamp_min_l=0.6, clamp_max_l=0.90),
+        'shadow': adjust_color_brightness_saturation(
+            dominant_color, brightness_factor=0.3, saturation_factor=3.0, clamp_min_l=0.25, clamp_max_l=0.55),
+    }
+
+def _encode_welcome_image(img, image_format=None, compress_level=None):
+    """Encode ảnh chào mừng theo WELCOME_IMAGE_FORMAT:
+    "png" (RGBA như cũ), "png-rgb" (bỏ kênh alpha), "png-palette" (PNG 256 màu) hoặc "webp"."""
+    image_format = image_format or WELCOME_IMAGE_FORMAT
+    compress_level = WELCOME_PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+    img_byte_arr = io.BytesIO()
+    if image_format == "webp":
+        img.save(img_byte_arr, format='WEBP', quality=WELCOME_WEBP_QUALITY, method=4)
+    elif image_format == "png-palette":
+        img.convert("RGB").quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(img_byte_arr, format='PNG', compress_level=compress_level)
+    elif image_format == "png-rgb":
+        img.convert("RGB").save(img_byte_arr, format='PNG', compress_level=compress_level)
+    else:
+        img.save(img_byte_arr, format='PNG', compress_level=compress_level)
+    return img_byte_arr.getvalue()
+
+def welcome_image_filename(base="welcome", image_format=None):
+    return f"{base}.{WELCOME_IMAGE_EXTENSIONS.get(image_format or WELCOME_IMAGE_FORMAT, 'png')}"
+
+def compose_welcome_image(avatar_data, display_name, colors=None, trace=None, style=None):
+    """Ghép ảnh chào mừng (giải mã avatar, lấy màu, dán avatar, vẽ chữ), chưa encode.
+    Nếu đã có `colors` (từ cache) thì bỏ qua bước lấy màu. `style` chọn nền / font của server. Trả về (ảnh PIL, colors)."""
+    trace = trace or WelcomeTrace()
+    # SỬA LỖI: Không tải lại tài nguyên. Font và nền nằm sẵn trong template (dựng một lần mỗi process / kiểu)
+    # TỐI ƯU: Nền, mask và vị trí chữ đã dựng sẵn trong template, ở đây chỉ tô màu + dán + vẽ tên
+    template = _render_template_for(style)
+    font_welcome, font_name, font_symbol = template['fonts']
+
+    img = template['background'].copy()
+    img_width, img_height = template['size']
     draw = ImageDraw.Draw(img)
-    shadow_offset_x = int(img_width * 0.005)
-    shadow_offset_y = int(img_height * 0.005)
+    shadow_offset_x, shadow_offset_y = template['shadow_offset']
 
-    avatar_url = member.avatar.url if member.avatar else member.default_avatar.url
-    avatar_img, avatar_bytes = await _get_and_process_avatar(avatar_url, AVATAR_SIZE, avatar_cache)
+    with trace.stage("avatar_decode"):
+        avatar_img = _decode_avatar(avatar_data, AVATAR_SIZE)
 
-    dominant_color_from_avatar = None
-    if avatar_bytes:
-        dominant_color_from_avatar = await get_dominant_color(avatar_bytes, color_count=20)
-    if dominant_color_from_avatar is None:
-        dominant_color_from_avatar = (0, 252, 233)
+    if colors is None:
+        dominant_color_from_avatar = None
+        if avatar_data:
+            with trace.stage("dominant_color"):
+                dominant_color_from_avatar = _extract_dominant_color(avatar_data, color_count=20, avatar_img=avatar_img)
+        if dominant_color_from_avatar is None:
+            dominant_color_from_avatar = (0, 252, 233)
+        colors = _derive_welcome_colors(dominant_color_from_avatar)
     
-    stroke_color_rgb = adjust_color_brightness_saturation(
-        dominant_color_from_avatar, brightness_factor=1.1, saturation_factor=4.9, clamp_min_l=0.6, clamp_max_l=0.90)
+    stroke_color_rgb = tuple(colors['stroke'])
     stroke_color = (*stroke_color_rgb, 255)
 
-    avatar_x = img_width // 2 - AVATAR_SIZE // 2
-    avatar_y = int(img_height * 0.36) - AVATAR_SIZE // 2
-    y_offset_from_avatar = 20
-    welcome_text_y_pos = avatar_y + AVATAR_SIZE + y_offset_from_avatar
+    avatar_x, avatar_y = template['avatar_pos']
+    with trace.stage("draw_avatar"):
+        _draw_circular_avatar_and_stroke(img, avatar_img, avatar_x, avatar_y, AVATAR_SIZE, stroke_color_rgb, template)
+    text_started = time.perf_counter()
 
-    _draw_circular_avatar_and_stroke(img, avatar_img, avatar_x, avatar_y, AVATAR_SIZE, stroke_color_rgb)
+    welcome_text_x, welcome_text_y_pos = template['welcome_text_pos']
+    shadow_color_welcome_rgb = tuple(colors['shadow'])
+    _draw_text_with_shadow(draw, WELCOME_TEXT, font_welcome, welcome_text_x, welcome_text_y_pos, (255, 255, 255), (*shadow_color_welcome_rgb, 255), shadow_offset_x, shadow_offset_y)
 
-    welcome_text = "WELCOME"
-    welcome_text_width = draw.textlength(welcome_text, font=FONT_WELCOME)
-    welcome_text_x = (img_width - welcome_text_width) / 2
-    shadow_color_welcome_rgb = adjust_color_brightness_saturation(
-        dominant_color_from_avatar, brightness_factor=0.3, saturation_factor=3.0, clamp_min_l=0.25, clamp_max_l=0.55)
-    _draw_text_with_shadow(draw, welcome_text, FONT_WELCOME, welcome_text_x, welcome_text_y_pos, (255, 255, 255), (*shadow_color_welcome_rgb, 255), shadow_offset_x, shadow_offset_y)
-
-    name_text_raw = member.display_name
+    name_text_raw = display_name
     max_chars_for_name = 25
     if len(name_text_raw) > max_chars_for_name:
         name_text_raw = name_text_raw[:max_chars_for_name - 3] + "..."
-    processed_name_parts, name_text_width = process_text_for_drawing(name_text_raw, FONT_NAME, FONT_SYMBOL, replacement_char='✦')
+    name_runs, name_text_width = process_text_for_drawing(name_text_raw, font_name, font_symbol, replacement_char='✦')
     name_text_x = (img_width - name_text_width) / 2
-    welcome_bbox_for_height = draw.textbbox((0, 0), welcome_text, font=FONT_WELCOME)
-    welcome_actual_height = welcome_bbox_for_height[3] - welcome_bbox_for_height[1]
-    name_text_y = welcome_text_y_pos + welcome_actual_height + 20
+    name_text_y = template['name_text_y']
     
-    shadow_color_name_rgb = adjust_color_brightness_saturation(
-        dominant_color_from_avatar, brightness_factor=0.3, saturation_factor=3.0, clamp_min_l=0.25, clamp_max_l=0.55)
-    shadow_color_name = (*shadow_color_name_rgb, 255)
-
-    current_x = name_text_x
-    for char, font_to_use in processed_name_parts:
-        draw.text((current_x + shadow_offset_x, name_text_y + shadow_offset_y), char, font=font_to_use, fill=shadow_color_name)
-        draw.text((current_x, name_text_y), char, font=font_to_use, fill=stroke_color)
-        current_x += draw.textlength(char, font=font_to_use)
-
-    name_actual_height = _get_text_height("M", FONT_NAME, draw)
-    line_y = name_text_y + name_actual_height + LINE_VERTICAL_OFFSET_FROM_NAME
+    # Bóng chữ tên dùng cùng công thức màu với bóng chữ WELCOME
+    shadow_color_name = (*shadow_color_welcome_rgb, 255)
+
+    for run_text, font_to_use, run_x in name_runs:
+        draw.text((name_text_x + run_x + shadow_offset_x, name_text_y + shadow_offset_y), run_text, font=font_to_use, fill=shadow_color_name)
+    for run_text, font_to_use, run_x in name_runs:
+        draw.text((name_text_x + run_x, name_text_y), run_text, font=font_to_use, fill=stroke_color)
+
+    line_y = name_text_y + template['name_actual_height'] + LINE_VERTICAL_OFFSET_FROM_NAME
     line_color_rgb = stroke_color_rgb
     actual_line_length = int(name_text_width * LINE_LENGTH_FACTOR)
     _draw_simple_decorative_line(draw, img_width, line_y, line_color_rgb, actual_line_length)
+    trace.record("draw_text", (time.perf_counter() - text_started) * 1000)
 
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='PNG')
-    img_byte_arr.seek(0)
-    return img_byte_arr
+    return img, colors
+
+def render_welcome_image(avatar_data, display_name, colors=None, style=None):
+    """Phần tốn CPU của ảnh chào mừng (ghép ảnh + encode).
+    Hàm đồng bộ, chạy trong thread hoặc process của backend render.
+    Trả về (bytes ảnh, colors, thời gian từng bước tính bằng ms)."""
+    trace = WelcomeTrace()
+    img, colors = compose_welcome_image(avatar_data, display_name, colors, trace, style)
+    with trace.stage("encode"):
+        image_bytes = _encode_welcome_image(img)
+    return image_bytes, colors, trace.stages
+
+def _init_render_worker():
+    """Initializer của mỗi process render: tải font, ảnh nền và template đúng một lần."""
+    _load_fonts(FONT_MAIN_PATH, FONT_SYMBOL_PATH)
+    _load_background_image(BACKGROUND_IMAGE_PATH, DEFAULT_IMAGE_DIMENSIONS)
+    _build_render_template()
+
+def _start_render_executor():
+    global RENDER_EXECUTOR
+    if RENDER_EXECUTOR is None and RENDER_BACKEND == "process":
+        # Không fork thẳng từ process bot (đã có thread Flask, watchdog, to_thread): process con có thể kẹt lock
+        # do thread khác đang giữ lúc fork. forkserver / spawn tạo process con sạch, chỉ import lại module.
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        RENDER_EXECUTOR = concurrent.futures.ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=_init_render_worker,
+                                                                 mp_context=multiprocessing.get_context(start_method))
+        print(f"DEBUG: Đã khởi động process pool render với {RENDER_WORKERS} worker ({start_method}).")
+    return RENDER_EXECUTOR
+
+def _discard_render_executor(executor):
+    """Bỏ process pool đã hỏng (vd worker bị OOM kill) để lần sau _start_render_executor dựng pool mới."""
+    global RENDER_EXECUTOR
+    if RENDER_EXECUTOR is executor:
+        RENDER_EXECUTOR = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+async def _render_in_backend(avatar_data, display_name, colors, style):
+    """Gọi render_welcome_image trên backend đang cấu hình. Pool process hỏng thì dựng lại và thử thêm một lần,
+    vẫn hỏng thì render trong thread cho lượt này thay vì chỉ gửi lời chào bằng chữ."""
+    if RENDER_BACKEND == "process":
+        for _ in range(2):
+            executor = _start_render_executor()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, render_welcome_image, avatar_data, display_name, colors, style)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                print(f"LỖI RENDER: Process pool render bị hỏng ({e}), dựng lại pool.")
+                _discard_render_executor(executor)
+        print("LỖI RENDER: Process pool vẫn hỏng sau khi dựng lại, render lượt này trong thread.")
+    return await asyncio.to_thread(render_welcome_image, avatar_data, display_name, colors, style)
+
+def _welcome_card_key(member):
+    avatar_asset = member.avatar if member.avatar else member.default_avatar
+    return (avatar_asset.key, member.display_name, GUILD_CONFIG.get(member.guild.id).style)
+
+def _cached_welcome_card(member, trace, store=True):
+    """Ảnh hoàn chỉnh đã cache (BytesIO) hoặc None. Hit thì bỏ qua cả tải avatar lẫn render.
+    `store=False` (render xem trước): chỉ peek, không đếm hit/miss."""
+    lookup = WELCOME_CARD_CACHE.get if store else WELCOME_CARD_CACHE.peek
+    cached_card = lookup(_welcome_card_key(member))
+    if cached_card is None:
+        trace.note("card_cache", "miss")
+        return None
+    print(f"DEBUG: Lấy ảnh chào mừng từ cache cho {member.display_name}.")
+    trace.note("card_cache", "hit")
+    return io.BytesIO(cached_card)
+
+async def create_welcome_image(member, trace=None, use_card_cache=True, store=True):
+    # use_card_cache=False: luôn render lại (dùng cho /testwelcome_bulk khi đo thông lượng)
+    # store=False: không ghi vào cache avatar / màu / ảnh / đĩa (render xem trước không đẩy bản thật ra khỏi cache)
+    trace = trace or WelcomeTrace(f"welcome:{member.display_name}")
+    cached_card = _cached_welcome_card(member, trace, store) if use_card_cache else None
+    if cached_card is not None:
+        return cached_card
+    return await _render_welcome_card(member, trace, store)
+
+async def _render_welcome_card(member, trace, store=True):
+    # Phía async chỉ tải avatar; phần vẽ chạy ngoài event loop (thread hoặc process pool)
+    avatar_key, _, style = card_key = _welcome_card_key(member)
+
+    # Render xem trước (store=False) chỉ peek: không đếm hit/miss, không đổi thứ tự LRU, không chạm last_access trên đĩa
+    colors = WELCOME_COLOR_CACHE.get(avatar_key) if store else WELCOME_COLOR_CACHE.peek(avatar_key)
+    trace.note("color_cache", "hit" if colors is not None else "miss")
+    avatar_data = None
+    from_disk = False
+    if colors is None:
+        # Cache đĩa có sẵn avatar đã resize + màu: không cần tải từ CDN
+        with trace.stage("disk_cache"):
+            found = await disk_cache_lookup(avatar_key, trace, record=store)
+        if found:
+            avatar_data, colors = found
+            from_disk = True
+    if avatar_data is None:
+        with trace.stage("avatar_fetch"):
+            avatar_data = await _get_and_process_avatar(_avatar_fetch_urls(member, AVATAR_SIZE), avatar_cache, trace, store)
+    with trace.stage("render_roundtrip"):
+        image_bytes, colors, render_stages = await _render_in_backend(avatar_data, member.display_name, colors, style)
+    trace.merge(render_stages)
+
+    # Chỉ ghi nhớ khi tải được avatar thật, tránh cache ảnh avatar xám tạm thời
+    if avatar_data and store:
+        if not from_disk and avatar_key not in WELCOME_COLOR_CACHE:
+            disk_cache_store_later(avatar_key, avatar_data, colors)
+        WELCOME_COLOR_CACHE.put(avatar_key, colors)
+        WELCOME_CARD_CACHE.put(card_key, image_bytes)
+    return io.BytesIO(image_bytes)
+
+async def create_welcome_image_limited(member, trace=None, use_card_cache=True, store=True):
+    """create_welcome_image dưới IMAGE_GEN_SEMAPHORE, ghi lại thời gian chờ semaphore vào trace.
+    Ảnh đã cache được trả về ngay, không phải xếp hàng sau các lượt render thật."""
+    trace = trace or WelcomeTrace(f"welcome:{member.display_name}")
+    if not IMAGE_GEN_SEMAPHORE:
+        return await create_welcome_image(member, trace, use_card_cache, store)
+    cached_card = _cached_welcome_card(member, trace, store) if use_card_cache else None
+    if cached_card is not None:
+        return cached_card
+    wait_started = time.perf_counter()
+    RENDER_ACTIVITY['waiting'] += 1
+    try:
+        await IMAGE_GEN_SEMAPHORE.acquire()
+    finally:
+        RENDER_ACTIVITY['waiting'] -= 1
+    RENDER_ACTIVITY['running'] += 1
+    try:
+        trace.record("semaphore_wait", (time.perf_counter() - wait_started) * 1000)
+        return await _render_welcome_card(member, trace, store)
+    finally:
+        RENDER_ACTIVITY['running'] -= 1
+        IMAGE_GEN_SEMAPHORE.release()
+
+# --- Làm nóng cache avatar / màu cho các thành viên hay được chào (tùy chọn) ---
+# Bật bằng AVATAR_WARMUP=1. Worker chạy ưu tiên thấp: chỉ làm khi không có render thật,
+# giới hạn tỉ lệ thời gian làm việc (AVATAR_WARMUP_CPU_BUDGET) và chỉ dùng một phần cache avatar.
+AVATAR_WARMUP_ENABLED = os.getenv("AVATAR_WARMUP", "0") == "1"
+AVATAR_WARMUP_RECENT_JOINERS = int(os.getenv("AVATAR_WARMUP_RECENT_JOINERS", "50"))
+AVATAR_WARMUP_MAX_TARGETS = int(os.getenv("AVATAR_WARMUP_MAX_TARGETS", "200"))
+AVATAR_WARMUP_INTERVAL = float(os.getenv("AVATAR_WARMUP_INTERVAL", "300"))
+AVATAR_WARMUP_CPU_BUDGET = float(os.getenv("AVATAR_WARMUP_CPU_BUDGET", "0.2"))
+AVATAR_WARMUP_CACHE_SHARE = float(os.getenv("AVATAR_WARMUP_CACHE_SHARE", "0.75"))
+
+def compute_welcome_colors(avatar_data):
+    """Chỉ giải mã avatar và tính màu viền/bóng như compose_welcome_image, không vẽ ảnh."""
+    avatar_img = _decode_avatar(avatar_data, AVATAR_SIZE)
+    dominant = _extract_dominant_color(avatar_data, color_count=20, avatar_img=avatar_img) or (0, 252, 233)
+    return _derive_welcome_colors(dominant)
+
+def _renders_active():
+    """Có render / lượt join thật đang chạy hoặc đang chờ không."""
+    if JOIN_QUEUE.depth() > 0:
+        return True
+    return RENDER_ACTIVITY['waiting'] + RENDER_ACTIVITY['running'] > 0
+
+class AvatarWarmup:
+    """Danh sách thành viên cần làm nóng (người join gần đây lúc khởi động, người hay được /testwelcome) và worker làm nóng.
+    Lượt join mới không được thêm vào: ảnh của họ vừa render xong nên avatar / màu đã nằm sẵn trong cache."""
+
+    def __init__(self, max_targets, cpu_budget, cache_share):
+        self.max_targets = max_targets
+        self.cpu_budget = cpu_budget
+        self.cache_share = cache_share
+        self._targets = OrderedDict()
+        self.warmed = 0
+        self.skipped_cached = 0
+        self.skipped_budget = 0
+        self.busy_waits = 0
+
+    def remember(self, member):
+        key = (member.guild.id, member.id)
+        self._targets[key] = None
+        self._targets.move_to_end(key)
+        while len(self._targets) > self.max_targets:
+            self._targets.popitem(last=False)
+
+    def seed_recent_joiners(self, guilds, limit):
+        """Lấy `limit` thành viên join gần nhất có trong cache của mỗi server."""
+        for guild in guilds:
+            members = [m for m in guild.members if m.joined_at and not m.bot]
+            members.sort(key=lambda m: m.joined_at)
+            for member in members[-limit:]:
+                self.remember(member)
+
+    def _cache_has_room(self):
+        return avatar_cache.current_bytes < avatar_cache.max_bytes * self.cache_share
+
+    async def warm(self, member):
+        """Tải avatar vào avatar_cache và tính sẵn màu vào WELCOME_COLOR_CACHE. Trả về thời gian làm việc (giây)."""
+        avatar_asset = member.avatar if member.avatar else member.default_avatar
+        if avatar_asset.key in WELCOME_COLOR_CACHE:
+            self.skipped_cached += 1
+            return 0.0
+        if not self._cache_has_room():
+            self.skipped_budget += 1
+            return 0.0
+        started = time.perf_counter()
+        found = await disk_cache_lookup(avatar_asset.key)
+        if found:
+            WELCOME_COLOR_CACHE.put(avatar_asset.key, found[1])
+            self.warmed += 1
+            return time.perf_counter() - started
+        avatar_data = await _get_and_process_avatar(_avatar_fetch_urls(member, AVATAR_SIZE), avatar_cache)
+        if avatar_data:
+            colors = await asyncio.to_thread(compute_welcome_colors, avatar_data)
+            WELCOME_COLOR_CACHE.put(avatar_asset.key, colors)
+            disk_cache_store_later(avatar_asset.key, avatar_data, colors)
+            self.warmed += 1
+        return time.perf_counter() - started
+
+    async def run_once(self):
+        for guild_id, member_id in list(self._targets):
+            guild = bot.get_guild(guild_id)
+            member = guild.get_member(member_id) if guild else None
+            if member is None:
+                self._targets.pop((guild_id, member_id), None)
+                continue
+            # Nhường hoàn toàn cho render thật
+            while _renders_active():
+                self.busy_waits += 1
+                await asyncio.sleep(1)
+            try:
+                work = await self.warm(member)
+            except Exception as e:
+                print(f"LỖI LÀM NÓNG AVATAR: {member.display_name}: {e}")
+                continue
+            if work and self.cpu_budget < 1:
+                # Duty cycle: làm `work` giây thì nghỉ tương ứng để chỉ chiếm cpu_budget thời gian
+                await asyncio.sleep(work * (1 / self.cpu_budget - 1))
+
+    def stats(self):
+        return {
+            'targets': len(self._targets),
+            'warmed': self.warmed,
+            'skipped_cached': self.skipped_cached,
+            'skipped_budget': self.skipped_budget,
+            'busy_waits': self.busy_waits,
+        }
+
+AVATAR_WARMUP = AvatarWarmup(AVATAR_WARMUP_MAX_TARGETS, AVATAR_WARMUP_CPU_BUDGET, AVATAR_WARMUP_CACHE_SHARE)
+
+async def avatar_warmup_worker():
+    await bot.wait_until_ready()
+    AVATAR_WARMUP.seed_recent_joiners(bot.guilds, AVATAR_WARMUP_RECENT_JOINERS)
+    print(f"DEBUG: avatar_warmup_worker bắt đầu với {len(AVATAR_WARMUP._targets)} thành viên.")
+    while True:
+        try:
+            await AVATAR_WARMUP.run_once()
+        except Exception as e:
+            print(f"LỖI LÀM NÓNG AVATAR: {e}")
+        await asyncio.sleep(AVATAR_WARMUP_INTERVAL)
+
+# --- Gửi tin nhắn có đếm số liệu ---
+DISCORD_SEND_COUNTERS = {'send_total': 0, 'send_errors_total': 0, 'send_429_total': 0, 'ratelimit_warnings_total': 0}
+
+async def tracked_send(channel, *args, **kwargs):
+    """channel.send kèm đếm số lần gửi / lỗi / 429 cho /metrics."""
+    DISCORD_SEND_COUNTERS['send_total'] += 1
+    try:
+        return await channel.send(*args, **kwargs)
+    except discord.errors.HTTPException as e:
+        DISCORD_SEND_COUNTERS['send_errors_total'] += 1
+        if getattr(e, 'status', None) == 429:
+            DISCORD_SEND_COUNTERS['send_429_total'] += 1
+        raise
+
+class _RateLimitLogCounter(logging.Handler):
+    """Đếm các cảnh báo 429 mà discord.py tự xử lý (tự chờ rồi gửi lại) và vẫn in chúng ra như trước."""
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            return
+        if "rate limited" in message or "429" in message:
+            DISCORD_SEND_COUNTERS['ratelimit_warnings_total'] += 1
+        if record.levelno >= logging.WARNING:
+            print(f"CẢNH BÁO DISCORD: {message}")
+
+_discord_http_logger = logging.getLogger("discord.http")
+_discord_http_logger.addHandler(_RateLimitLogCounter(level=logging.WARNING))
+
+# --- Bộ lập lịch gửi ra ngoài: ưu tiên + bucket rate limit theo kênh ---
+# Số càng nhỏ càng được gửi trước
+PRIORITY_WELCOME = 0
+PRIORITY_ROLE_EDIT = 0
+PRIORITY_LEVEL_UP = 1
+PRIORITY_AUTO_REPLY = 2
+PRIORITY_CHATTER = 3
+OUTBOUND_QUEUE_MAX = int(os.getenv("OUTBOUND_QUEUE_MAX", "200"))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "4"))
+# Khi hàng đợi dài hơn ngưỡng này, lệnh gửi có mức ưu tiên >= OUTBOUND_DROPPABLE_PRIORITY bị bỏ luôn
+OUTBOUND_PRESSURE_THRESHOLD = int(os.getenv("OUTBOUND_PRESSURE_THRESHOLD", "50"))
+OUTBOUND_DROPPABLE_PRIORITY = PRIORITY_AUTO_REPLY
+# Discord cho bot gửi khoảng 5 tin nhắn / 5 giây trên mỗi kênh
+OUTBOUND_BUCKET_CAPACITY = int(os.getenv("OUTBOUND_BUCKET_CAPACITY", "5"))
+OUTBOUND_BUCKET_PERIOD = float(os.getenv("OUTBOUND_BUCKET_PERIOD", "5"))
+
+class _OutboundBucket:
+    """Token bucket cho một kênh (hoặc một nhóm request), bị khóa thêm khi Discord trả về 429."""
+
+    def __init__(self, capacity, period, now):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Số giây còn phải chờ trước khi được gửi (0 nếu gửi được ngay)."""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+class _OutboundJob:
+    __slots__ = ('priority', 'bucket_key', 'factory', 'coalesce_key', 'wait', 'label', 'enqueued_at', 'future', 'throttled')
+
+    def __init__(self, priority, bucket_key, factory, coalesce_key, wait, label, enqueued_at, future):
+        self.priority = priority
+        self.bucket_key = bucket_key
+        self.factory = factory
+        self.coalesce_key = coalesce_key
+        self.wait = wait
+        self.label = label
+        self.enqueued_at = enqueued_at
+        self.future = future
+        self.throttled = False
+
+class OutboundScheduler:
+    """Hàng đợi trung tâm cho mọi lệnh gửi tin nhắn / sửa role ra Discord.
+
+    - Lệnh có mức ưu tiên cao (số nhỏ) luôn được lấy trước; lệnh của kênh đang hết lượt thì nhường cho kênh khác.
+    - Mỗi `bucket_key` (thường là id kênh) có token bucket riêng, nên bot tự giữ nhịp thay vì để discord.py ngủ chờ 429.
+    - Hàng đợi có giới hạn: đầy thì bỏ lệnh ưu tiên thấp nhất, lệnh ưu tiên cao phải chờ (backpressure).
+    - Khi quá tải, lệnh ưu tiên thấp bị bỏ; lệnh cùng `coalesce_key` đang chờ được gộp (chỉ giữ nội dung mới nhất).
+    """
+
+    def __init__(self, max_size, concurrency, pressure_threshold, droppable_priority, bucket_capacity, bucket_period):
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.pressure_threshold = pressure_threshold
+        self.droppable_priority = droppable_priority
+        self.bucket_capacity = bucket_capacity
+        self.bucket_period = bucket_period
+        self._queues = {}
+        self._size = 0
+        self._coalesce = {}
+        self._buckets = {}
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._task = None
+        self._running = set()
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.max_depth = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._dispatcher())
+        print(f"DEBUG: Bộ lập lịch gửi tin chạy với tối đa {self.concurrency} lệnh song song.")
+
+    def depth(self):
+        return self._size
+
+    async def send(self, channel, *args, priority=PRIORITY_CHATTER, coalesce_key=None, wait=True, **kwargs):
+        """tracked_send qua hàng đợi, bucket theo id kênh."""
+        label = f"#{getattr(channel, 'name', channel.id)}"
+        return await self.submit(priority, channel.id, lambda: tracked_send(channel, *args, **kwargs),
+                                 coalesce_key=coalesce_key, wait=wait, label=label)
+
+    async def submit(self, priority, bucket_key, factory, coalesce_key=None, wait=True, label=""):
+        """Xếp một lệnh (coroutine factory) vào hàng đợi.
+
+        wait=True: chờ lệnh chạy xong và trả về kết quả (lỗi được ném lại cho người gọi).
+        wait=False: trả về ngay, lỗi chỉ được in ra. Trả về None nếu lệnh bị bỏ vì quá tải.
+        """
+        self.start()
+        self.submitted += 1
+        existing = self._coalesce.get(coalesce_key) if coalesce_key is not None else None
+        if existing is not None:
+            existing.factory = factory
+            existing.wait = existing.wait or wait
+            self.coalesced += 1
+            return await existing.future if wait else None
+
+        if priority >= self.droppable_priority and self._size >= self.pressure_threshold:
+            self._drop(label, "hàng đợi quá tải")
+            return None
+        while self._size >= self.max_size:
+            if self._evict_lower_than(priority):
+                break
+            if priority >= self.droppable_priority:
+                self._drop(label, "hàng đợi đầy")
+                return None
+            self._space.clear()
+            await self._space.wait()
+
+        loop = asyncio.get_running_loop()
+        job = _OutboundJob(priority, bucket_key, factory, coalesce_key, wait, label, loop.time(), loop.create_future())
+        self._queues.setdefault(priority, deque()).append(job)
+        self._size += 1
+        self.max_depth = max(self.max_depth, self._size)
+        if coalesce_key is not None:
+            self._coalesce[coalesce_key] = job
+        self._wakeup.set()
+        return await job.future if wait else None
+
+    def _drop(self, label, reason):
+        self.dropped += 1
+        print(f"DEBUG: Bỏ lệnh gửi {label} ({reason}, {self._size} lệnh đang chờ).")
+
+    def _evict_lower_than(self, priority):
+        """Bỏ lệnh mới nhất thuộc nhóm ưu tiên thấp nhất (thấp hơn `priority`) để lấy chỗ."""
+        for lowest in sorted(self._queues, reverse=True):
+            if lowest <= priority:
+                return False
+            queue = self._queues[lowest]
+            if queue:
+                job = queue.pop()
+                self._forget(job)
+                self._drop(job.label, "nhường chỗ cho lệnh ưu tiên cao hơn")
+                if not job.future.done():
+                    job.future.set_result(None)
+                return True
+        return False
+
+    def _forget(self, job):
+        self._size -= 1
+        if job.coalesce_key is not None and self._coalesce.get(job.coalesce_key) is job:
+            del self._coalesce[job.coalesce_key]
+        self._space.set()
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= 1024:
+                # Dọn các bucket đã đầy token (kênh lâu không gửi) để dict không phình mãi
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.idle(now)}
+            bucket = self._buckets[key] = _OutboundBucket(self.bucket_capacity, self.bucket_period, now)
+        return bucket
+
+    def _next_ready(self, now):
+        """Lấy lệnh ưu tiên cao nhất mà bucket còn lượt; nếu không có thì trả về thời gian chờ ngắn nhất."""
+        earliest = None
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            for job in queue:
+                bucket = self._bucket(job.bucket_key, now)
+                delay = bucket.delay(now)
+                if delay <= 0:
+                    queue.remove(job)
+                    self._forget(job)
+                    bucket.take(now)
+                    return job, None
+                if not job.throttled:
+                    job.throttled = True
+                    self.throttled += 1
+                earliest = delay if earliest is None else min(earliest, delay)
+        return None, earliest
+
+    async def _dispatcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            job, delay = self._next_ready(loop.time())
+            while job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                job, delay = self._next_ready(loop.time())
+            task = asyncio.create_task(self._run(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        wait = loop.time() - job.enqueued_at
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            result = await job.factory()
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            self.failed += 1
+            retry_after = _retry_after_from(e) if getattr(e, 'status', 429) == 429 else None
+            if retry_after:
+                # Discord vẫn trả 429: khóa bucket này đến hết retry_after thay vì gửi tiếp
+                bucket = self._bucket(job.bucket_key, loop.time())
+                bucket.blocked_until = max(bucket.blocked_until, loop.time() + retry_after)
+            if job.wait:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                print(f"LỖI GỬI TIN: Lệnh gửi {job.label} thất bại: {e}")
+                if not job.future.done():
+                    job.future.set_result(None)
+        finally:
+            self._slots.release()
+            self._wakeup.set()
+
+    def stats(self):
+        return {
+            'depth': self._size,
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'throttled': self.throttled,
+            'last_wait_seconds': self.last_wait,
+            'max_wait_seconds': self.max_wait,
+            'buckets': len(self._buckets),
+        }
+
+OUTBOUND = OutboundScheduler(OUTBOUND_QUEUE_MAX, OUTBOUND_CONCURRENCY, OUTBOUND_PRESSURE_THRESHOLD,
+                             OUTBOUND_DROPPABLE_PRIORITY, OUTBOUND_BUCKET_CAPACITY, OUTBOUND_BUCKET_PERIOD)
+
+# --- Báo cáo bộ nhớ / lưu lượng gateway để so sánh các GATEWAY_PROFILE ---
+# Đặt MEMORY_REPORT_INTERVAL (giây) > 0 để đếm sự kiện gateway và in báo cáo định kỳ
+MEMORY_REPORT_INTERVAL = float(os.getenv("MEMORY_REPORT_INTERVAL", "0"))
+GATEWAY_EVENT_COUNTS = {}
+
+async def _count_gateway_event(event_type):
+    GATEWAY_EVENT_COUNTS[event_type] = GATEWAY_EVENT_COUNTS.get(event_type, 0) + 1
+
+if MEMORY_REPORT_INTERVAL > 0:
+    bot.add_listener(_count_gateway_event, "on_socket_event_type")
+
+# --- Số liệu theo shard: độ trễ gateway và số sự kiện / tốc độ sự kiện của từng shard ---
+SHARD_EVENT_COUNTS = {}
+SHARD_EVENT_RATES = {}
+_SHARD_RATE_STATE = {'counts': {}, 'at': None}
+
+def count_shard_event(guild, event):
+    """Đếm sự kiện theo (shard của guild, loại sự kiện). DM / không có guild tính vào shard 0."""
+    shard_id = (guild.shard_id if guild is not None else 0) or 0
+    key = (shard_id, event)
+    SHARD_EVENT_COUNTS[key] = SHARD_EVENT_COUNTS.get(key, 0) + 1
+
+def update_shard_event_rates(now=None):
+    """Tốc độ sự kiện (sự kiện/giây) của từng shard kể từ lần gọi trước; gọi định kỳ từ metrics_snapshot_worker."""
+    now = time.monotonic() if now is None else now
+    previous, previous_at = _SHARD_RATE_STATE['counts'], _SHARD_RATE_STATE['at']
+    if previous_at is not None and now > previous_at:
+        elapsed = now - previous_at
+        rates = {key: (count - previous.get(key, 0)) / elapsed for key, count in SHARD_EVENT_COUNTS.items()}
+        SHARD_EVENT_RATES.clear()
+        SHARD_EVENT_RATES.update(rates)
+    _SHARD_RATE_STATE['counts'] = dict(SHARD_EVENT_COUNTS)
+    _SHARD_RATE_STATE['at'] = now
+
+def shard_latencies():
+    """[(shard_id, độ trễ giây)]; bot không chia shard được tính là shard 0."""
+    latencies = getattr(bot, 'latencies', None)
+    return list(latencies) if latencies is not None else [(0, bot.latency)]
+
+def _shard_gateway_listener(event):
+    async def listener(shard_id):
+        SHARD_EVENT_COUNTS[(shard_id, event)] = SHARD_EVENT_COUNTS.get((shard_id, event), 0) + 1
+        if event != "gateway_connect":
+            print(f"DEBUG: Shard {shard_id}: {event}.")
+    return listener
+
+for _shard_event in ("connect", "disconnect", "resumed", "ready"):
+    bot.add_listener(_shard_gateway_listener(f"gateway_{_shard_event}"), f"on_shard_{_shard_event}")
+
+def memory_report():
+    """RSS, kích thước cache của discord.py và số sự kiện gateway đã nhận."""
+    return {
+        'profile': GATEWAY_PROFILE,
+        'rss_mb': _process_rss_bytes() / (1024 * 1024),
+        'guilds': len(bot.guilds),
+        'cached_members': sum(len(guild.members) for guild in bot.guilds),
+        'cached_messages': len(bot.cached_messages),
+        'gateway_events': sum(GATEWAY_EVENT_COUNTS.values()),
+        'gateway_events_by_type': dict(GATEWAY_EVENT_COUNTS),
+    }
+
+async def memory_report_worker():
+    await bot.wait_until_ready()
+    previous_events = 0
+    while True:
+        try:
+            await asyncio.sleep(MEMORY_REPORT_INTERVAL)
+            report = memory_report()
+            per_minute = (report['gateway_events'] - previous_events) * 60 / MEMORY_REPORT_INTERVAL
+            previous_events = report['gateway_events']
+            top = sorted(report['gateway_events_by_type'].items(), key=lambda kv: -kv[1])[:5]
+            print(f"BÁO CÁO BỘ NHỚ [{report['profile']}]: RSS={report['rss_mb']:.1f}MB, member cache={report['cached_members']}, "
+                  f"tin nhắn cache={report['cached_messages']}, sự kiện gateway={per_minute:.0f}/phút, nhiều nhất={top}")
+        except Exception as e:
+            print(f"LỖI BÁO CÁO BỘ NHỚ: {e}")
+
+# --- Số liệu cho /metrics ---
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "10"))
+LOOP_LAG = {'last': 0.0, 'max': 0.0}
+
+def _process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Không có /proc: dùng RSS đỉnh (KB trên Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _prom_line(lines, name, value, labels=None):
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return
+    label_text = ""
+    if labels:
+        label_text = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+    lines.append(f"{name}{label_text} {value}")
+
+def build_metrics_text():
+    """Dựng nội dung /metrics (định dạng text của Prometheus). Chỉ gọi trên event loop."""
+    lines = []
+    lines.append("# TYPE botmlem_event_loop_lag_seconds gauge")
+    _prom_line(lines, "botmlem_event_loop_lag_seconds", round(LOOP_LAG['last'], 6))
+    _prom_line(lines, "botmlem_event_loop_lag_max_seconds", round(LOOP_LAG['max'], 6))
+    lines.append("# TYPE botmlem_event_loop_stalls_total counter")
+    _prom_line(lines, "botmlem_event_loop_stalls_total", LOOP_WATCHDOG['stalls'])
+    _prom_line(lines, "botmlem_event_loop_stall_seconds_total", round(LOOP_WATCHDOG['stall_seconds_total'], 3))
+    lines.append("# TYPE botmlem_gateway_latency_seconds gauge")
+    _prom_line(lines, "botmlem_gateway_latency_seconds", bot.latency)
+    lines.append("# TYPE botmlem_shard_latency_seconds gauge")
+    for shard_id, latency in shard_latencies():
+        _prom_line(lines, "botmlem_shard_latency_seconds", latency, {'shard': shard_id})
+    lines.append("# TYPE botmlem_shard_events_total counter")
+    for (shard_id, event), count in sorted(SHARD_EVENT_COUNTS.items()):
+        _prom_line(lines, "botmlem_shard_events_total", count, {'shard': shard_id, 'event': event})
+    lines.append("# TYPE botmlem_shard_event_rate gauge")
+    for (shard_id, event), rate in sorted(SHARD_EVENT_RATES.items()):
+        _prom_line(lines, "botmlem_shard_event_rate", round(rate, 3), {'shard': shard_id, 'event': event})
+    lines.append("# TYPE botmlem_process_resident_memory_bytes gauge")
+    _prom_line(lines, "botmlem_process_resident_memory_bytes", _process_rss_bytes())
+
+    lines.append("# TYPE botmlem_gateway_events_total counter")
+    for event_type, count in sorted(GATEWAY_EVENT_COUNTS.items()):
+        _prom_line(lines, "botmlem_gateway_events_total", count, {'type': event_type})
+    _prom_line(lines, "botmlem_cached_members", sum(len(guild.members) for guild in bot.guilds))
+
+    # Histogram lưu theo ms, xuất ra theo giây đúng quy ước Prometheus
+    lines.append("# TYPE botmlem_welcome_stage_duration_seconds histogram")
+    for stage, histogram in sorted(STAGE_HISTOGRAMS.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            _prom_line(lines, "botmlem_welcome_stage_duration_seconds_bucket", cumulative, {'stage': stage, 'le': bound / 1000})
+        _prom_line(lines, "botmlem_welcome_stage_duration_seconds_bucket", histogram.count, {'stage': stage, 'le': "+Inf"})
+        _prom_line(lines, "botmlem_welcome_stage_duration_seconds_sum", round(histogram.sum / 1000, 6), {'stage': stage})
+        _prom_line(lines, "botmlem_welcome_stage_duration_seconds_count", histogram.count, {'stage': stage})
+    lines.append("# TYPE botmlem_welcome_events_total counter")
+    for event, count in sorted(TRACE_COUNTERS.items()):
+        _prom_line(lines, "botmlem_welcome_events_total", count, {'event': event})
+
+    lines.append("# TYPE botmlem_render_semaphore_waiters gauge")
+    _prom_line(lines, "botmlem_render_semaphore_waiters", RENDER_ACTIVITY['waiting'])
+    _prom_line(lines, "botmlem_renders_running", RENDER_ACTIVITY['running'])
+    for key, value in JOIN_QUEUE.stats().items():
+        _prom_line(lines, f"botmlem_join_queue_{key}", value)
+    for key, value in OUTBOUND.stats().items():
+        _prom_line(lines, f"botmlem_outbound_{key}", value)
+    for key, value in GUILD_CONFIG.stats().items():
+        _prom_line(lines, f"botmlem_guild_config_{key}", value)
+    for key, value in RANK_ENGINE.stats().items():
+        _prom_line(lines, f"botmlem_rank_{key}", value)
+    if avatar_disk_cache is not None:
+        for key, value in avatar_disk_cache.stats().items():
+            _prom_line(lines, f"botmlem_avatar_disk_cache_{key}", value)
+    for key, value in AVATAR_WARMUP.stats().items():
+        _prom_line(lines, f"botmlem_avatar_warmup_{key}", value)
+    _prom_line(lines, "botmlem_auto_reply_hits_total", AUTO_REPLY.hits)
+    _prom_line(lines, "botmlem_auto_reply_cooldown_skips_total", AUTO_REPLY.cooldown_skips)
+
+    for name, stats in welcome_cache_stats().items():
+        for key in ('entries', 'bytes', 'max_bytes', 'hits', 'misses', 'evictions', 'hit_rate'):
+            _prom_line(lines, f"botmlem_cache_{key}", stats[key], {'cache': name})
+
+    lines.append("# TYPE botmlem_discord_send_total counter")
+    for key, value in DISCORD_SEND_COUNTERS.items():
+        _prom_line(lines, f"botmlem_discord_{key}", value)
+    return "\n".join(lines) + "\n"
+
+# --- Watchdog event loop và profiler lấy mẫu ---
+# loop_heartbeat_worker đo độ trễ loop mỗi LOOP_WATCHDOG_INTERVAL giây (ghi vào LOOP_LAG). Một thread riêng
+# theo dõi nhịp này: loop bị chặn quá LOOP_STALL_THRESHOLD giây thì chụp stack của thread event loop
+# (chính đoạn code đang chặn). Đặt LOOP_STALL_THRESHOLD=0 để tắt thread watchdog.
+LOOP_WATCHDOG_INTERVAL = float(os.getenv("LOOP_WATCHDOG_INTERVAL", "0.25"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))
+PROFILE_MAX_SECONDS = 60
+PROFILE_SAMPLE_INTERVAL = 0.005
+LOOP_STALLS = deque(maxlen=20)
+LOOP_WATCHDOG = {'thread_id': None, 'heartbeat': 0.0, 'stalls': 0, 'stall_seconds_total': 0.0}
+_PROFILE_LOCK = threading.Lock()
+
+async def loop_heartbeat_worker():
+    loop = asyncio.get_running_loop()
+    LOOP_WATCHDOG['thread_id'] = threading.get_ident()
+    LOOP_WATCHDOG['heartbeat'] = time.monotonic()
+    if LOOP_STALL_THRESHOLD > 0:
+        threading.Thread(target=_loop_watchdog_thread, name="loop-watchdog", daemon=True).start()
+    while True:
+        expected = loop.time() + LOOP_WATCHDOG_INTERVAL
+        await asyncio.sleep(LOOP_WATCHDOG_INTERVAL)
+        lag = max(0.0, loop.time() - expected)
+        LOOP_LAG['last'] = lag
+        LOOP_LAG['max'] = max(LOOP_LAG['max'], lag)
+        LOOP_WATCHDOG['heartbeat'] = time.monotonic()
+
+def _loop_watchdog_thread():
+    stall = None
+    while True:
+        time.sleep(LOOP_WATCHDOG_INTERVAL)
+        blocked_for = time.monotonic() - LOOP_WATCHDOG['heartbeat'] - LOOP_WATCHDOG_INTERVAL
+        if blocked_for >= LOOP_STALL_THRESHOLD:
+            if stall is None:
+                # Chụp stack ngay khi vượt ngưỡng, lúc đoạn code chặn loop vẫn đang chạy
+                frame = sys._current_frames().get(LOOP_WATCHDOG['thread_id'])
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "(không lấy được stack)\n"
+                stall = {'started_at': time.time() - blocked_for, 'duration': blocked_for, 'stack': stack}
+                LOOP_STALLS.append(stall)
+                LOOP_WATCHDOG['stalls'] += 1
+                print(f"CẢNH BÁO LOOP: Event loop bị chặn hơn {blocked_for * 1000:.0f}ms, stack đang chạy:\n{stack}", end="")
+            else:
+                stall['duration'] = blocked_for
+        elif stall is not None:
+            LOOP_WATCHDOG['stall_seconds_total'] += stall['duration']
+            print(f"CẢNH BÁO LOOP: Event loop đã chạy lại sau ít nhất {stall['duration'] * 1000:.0f}ms bị chặn.")
+            stall = None
+
+def format_loop_stalls():
+    if not LOOP_STALLS:
+        return "Chưa ghi nhận lần nào event loop bị chặn.\n"
+    parts = []
+    for stall in reversed(LOOP_STALLS):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stall['started_at']))
+        parts.append(f"=== {started} bị chặn {stall['duration'] * 1000:.0f}ms ===\n{stall['stack']}")
+    return "\n".join(parts)
+
+def sample_loop_profile(seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """Lấy mẫu stack của thread event loop trong `seconds` giây (gọi từ thread khác, không phải từ loop).
+    Trả về (stack dạng folded cho flamegraph.pl / speedscope, số mẫu), hoặc None nếu đang có phiên profile khác."""
+    thread_id = LOOP_WATCHDOG['thread_id']
+    if thread_id is None or not _PROFILE_LOCK.acquire(blocking=False):
+        return None
+    try:
+        counts = {}
+        samples = 0
+        deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+                samples += 1
+            time.sleep(interval)
+        folded = "".join(f"{key} {count}\n" for key, count in sorted(counts.items(), key=lambda item: -item[1]))
+        return folded, samples
+    finally:
+        _PROFILE_LOCK.release()
+
+async def metrics_snapshot_worker():
+    """Dựng snapshot /metrics định kỳ, để thread Flask không chạm vào object discord.py.
+    Độ trễ event loop (LOOP_LAG) do loop_heartbeat_worker đo."""
+    while True:
+        try:
+            await asyncio.sleep(METRICS_INTERVAL)
+            update_shard_event_rates()
+            METRICS_SNAPSHOT['text'] = build_metrics_text()
+            METRICS_SNAPSHOT['updated_at'] = time.time()
+        except Exception as e:
+            print(f"LỖI METRICS: {e}")
 
 # --- Các worker và sự kiện Bot ---
 async def activity_heartbeat_worker():
@@ -377,32 +2111,33 @@ async def activity_heartbeat_worker():
             await bot.change_presence(activity=random.choice(activities))
             
             # 2. TỐI ƯU: Dọn dẹp bộ nhớ (xóa avatar cũ trong cache)
-            now = asyncio.get_event_loop().time()
-            expired = [k for k, v in avatar_cache.items() if now - v['timestamp'] > CACHE_TTL]
-            for k in expired: del avatar_cache[k]
+            avatar_cache.sweep_expired()
             
         except Exception as e:
             print(f"LỖI WORKER: {e}")
             await asyncio.sleep(30)
 
+RANDOM_CHANNEL_ID = 1379789952610467971
+RANDOM_MESSAGES = [
+    "Hôm nay trời đẹp ghê 😎", "Anh em nhớ uống nước nha 💧", "Ai đang onl vậy 🙌", "👺", "👾", "🤖", "💖", "💋", "👀", "😎", "🤞", "✨", "🤤",
+]
+
 async def random_message_worker():
     await bot.wait_until_ready()
     print("DEBUG: random_message_worker bắt đầu.")
-    channel_id = 1379789952610467971
-    messages = [
-        "Hôm nay trời đẹp ghê 😎", "Anh em nhớ uống nước nha 💧", "Ai đang onl vậy 🙌", "👺", "👾", "🤖", "💖", "💋", "👀", "😎", "🤞", "✨", "🤤",
-    ]
     while True:
         try:
             sleep_seconds = random.randint(300, 600)
             await asyncio.sleep(sleep_seconds)
-            channel = bot.get_channel(channel_id)
-            if channel:
-                msg = random.choice(messages)
-                await channel.send(msg)
-                print(f"DEBUG: Đã gửi tin nhắn: {msg}")
-            else:
-                print("DEBUG: Không tìm thấy channel để gửi tin.")
+            # Kênh và danh sách tin nhắn lấy theo config của từng server
+            for guild in bot.guilds:
+                config = GUILD_CONFIG.get(guild.id)
+                channel = guild.get_channel(config.random_channel_id) if config.random_channel_id else None
+                if channel and config.random_messages:
+                    msg = random.choice(config.random_messages)
+                    # Chatter ưu tiên thấp nhất: bị gộp / bỏ khi hàng đợi gửi đang bận
+                    await OUTBOUND.send(channel, msg, priority=PRIORITY_CHATTER, coalesce_key=("chatter", channel.id), wait=False)
+                    print(f"DEBUG: Đã xếp hàng tin nhắn: {msg}")
         except Exception as e:
             print(f"LỖI RANDOM_MESSAGE_WORKER: {e}")
             await asyncio.sleep(30)
@@ -421,20 +2156,211 @@ async def skibidi(interaction: discord.Interaction):
 async def testwelcome_slash(interaction: discord.Interaction, user: discord.Member = None):
     member_to_test = user if user else interaction.user
     await interaction.response.defer(thinking=True)
+    trace = WelcomeTrace(f"testwelcome:{member_to_test.display_name}")
+    error = None
     try:
         print(f"DEBUG: Đang tạo ảnh chào mừng cho {member_to_test.display_name}...")
-        image_bytes = None
-        if IMAGE_GEN_SEMAPHORE:
-            async with IMAGE_GEN_SEMAPHORE:
-                image_bytes = await create_welcome_image(member_to_test)
-        else:
-            image_bytes = await create_welcome_image(member_to_test)
-        await interaction.followup.send(file=discord.File(fp=image_bytes, filename="welcome_test.png"))
+        image_bytes = await create_welcome_image_limited(member_to_test, trace)
+        with trace.stage("send"):
+            await interaction.followup.send(file=discord.File(fp=image_bytes, filename=welcome_image_filename("welcome_test")))
+        AVATAR_WARMUP.remember(member_to_test)
         print(f"DEBUG: Đã gửi ảnh test chào mừng cho {member_to_test.display_name}.")
     except Exception as e:
+        error = e
         await interaction.followup.send(f"Có lỗi khi tạo hoặc gửi ảnh test: `{e}`\nKiểm tra lại hàm `create_welcome_image`.")
         print(f"LỖI TEST: {e}")
+    finally:
+        # Lượt lỗi vẫn được ghi vào histogram / trace chậm, kèm note error
+        trace.finish(error)
         
+# --- Slash Command: /testwelcome_bulk ---
+# Render thử ảnh chào mừng cho nhiều thành viên cùng lúc (theo role, danh sách user hoặc N người join gần nhất).
+# Đi qua IMAGE_GEN_SEMAPHORE chung nhưng luôn chừa ít nhất một chỗ cho lượt join thật (khi IMAGE_GEN_CONCURRENCY > 1).
+# Không ghi vào cache nào và không tính vào /metrics; kiêm luôn bài đo thông lượng render.
+BULK_PREVIEW_MAX = int(os.getenv("BULK_PREVIEW_MAX", "30"))
+BULK_PREVIEW_CONCURRENCY = max(1, min(int(os.getenv("BULK_PREVIEW_CONCURRENCY", str(IMAGE_GEN_CONCURRENCY - 1))),
+                                      IMAGE_GEN_CONCURRENCY - 1))
+BULK_PREVIEW_COLUMNS = int(os.getenv("BULK_PREVIEW_COLUMNS", "3"))
+BULK_PREVIEW_THUMB_WIDTH = int(os.getenv("BULK_PREVIEW_THUMB_WIDTH", "480"))
+
+async def collect_bulk_preview_members(guild, role=None, users=None, last_joiners=None, limit=BULK_PREVIEW_MAX):
+    """Gom thành viên cần render (bỏ trùng, giữ thứ tự: user chỉ định, role, người join gần nhất).
+    Trả về (danh sách member, số member bị cắt bớt do vượt `limit`)."""
+    members = []
+    for user_id in re.findall(r"\d{15,21}", users or ""):
+        member = guild.get_member(int(user_id))
+        if member is None:
+            try:
+                member = await guild.fetch_member(int(user_id))
+            except discord.HTTPException as e:
+                print(f"LỖI BULK PREVIEW: Không tìm thấy thành viên {user_id}: {e}")
+                continue
+        members.append(member)
+    if role is not None:
+        members.extend(role.members)
+    if last_joiners:
+        joined = [m for m in guild.members if m.joined_at is not None]
+        members.extend(sorted(joined, key=lambda m: m.joined_at, reverse=True)[:last_joiners])
+
+    # Bỏ trùng nhưng giữ vị trí lần xuất hiện đầu tiên, để ảnh ghép / zip theo đúng thứ tự yêu cầu
+    unique, seen = [], set()
+    for member in members:
+        if member.id not in seen:
+            seen.add(member.id)
+            unique.append(member)
+    return unique[:limit], max(0, len(unique) - limit)
+
+async def render_bulk_previews(members, concurrency=BULK_PREVIEW_CONCURRENCY, use_card_cache=False):
+    """Render song song (tối đa `concurrency` ảnh cùng lúc) qua create_welcome_image_limited, không ghi cache.
+    Trace chỉ dùng cho timings trả về, không vào histogram /metrics.
+    Trả về (danh sách kết quả theo thứ tự `members`, tổng thời gian tính bằng giây)."""
+    limiter = asyncio.Semaphore(max(1, concurrency))
+
+    async def render_one(member):
+        trace = WelcomeTrace(f"testwelcome_bulk:{member.display_name}", metrics=False)
+        result = {'member': member, 'image': None, 'error': None}
+        async with limiter:
+            started = time.perf_counter()
+            try:
+                result['image'] = (await create_welcome_image_limited(member, trace, use_card_cache, store=False)).getvalue()
+            except Exception as e:
+                result['error'] = str(e) or type(e).__name__
+                print(f"LỖI BULK PREVIEW: Không render được ảnh cho {member.display_name}: {e}")
+            result['ms'] = (time.perf_counter() - started) * 1000
+        result['stages'] = dict(trace.stages)
+        result['notes'] = dict(trace.notes)
+        return result
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(render_one(member) for member in members))
+    return list(results), time.perf_counter() - started
+
+def format_bulk_preview_timings(results, total_seconds, concurrency):
+    """Dòng tóm tắt và nội dung timings.txt (thời gian từng ảnh + từng bước)."""
+    rendered = [r for r in results if r['image'] is not None]
+    durations = sorted(r['ms'] for r in rendered)
+    summary = f"Render {len(rendered)}/{len(results)} ảnh trong {total_seconds:.2f}s"
+    if durations:
+        p50 = durations[len(durations) // 2]
+        p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        summary += (f" ({len(rendered) / max(total_seconds, 1e-9):.1f} ảnh/s, song song {concurrency}). "
+                    f"Mỗi ảnh: p50 {p50:.0f}ms, p95 {p95:.0f}ms, max {durations[-1]:.0f}ms.")
+    lines = [summary, ""]
+    for index, r in enumerate(results, 1):
+        member = r['member']
+        status = f"{r['ms']:.0f}ms" if r['error'] is None else f"LỖI {r['error']}"
+        stages = ", ".join(f"{k}={v:.0f}ms" for k, v in sorted(r['stages'].items(), key=lambda kv: -kv[1]))
+        notes = " ".join(f"{k}={v}" for k, v in r['notes'].items())
+        lines.append(f"{index:02d}. {member.display_name} ({member.id}): {status} | {stages} | {notes}")
+    return summary, "\n".join(lines) + "\n"
+
+def build_contact_sheet(results, columns=BULK_PREVIEW_COLUMNS, thumb_width=BULK_PREVIEW_THUMB_WIDTH):
+    """Ghép các ảnh đã render thành một lưới (contact sheet), dưới mỗi ảnh ghi tên + thời gian. Trả về bytes ảnh."""
+    width, height = DEFAULT_IMAGE_DIMENSIONS
+    thumb_height = round(height * thumb_width / width)
+    label_height, padding = 18, 8
+    columns = max(1, min(columns, len(results)))
+    rows = math.ceil(len(results) / columns)
+    cell_width, cell_height = thumb_width + padding, thumb_height + label_height + padding
+    sheet = Image.new("RGB", (columns * cell_width + padding, rows * cell_height + padding), (30, 31, 34))
+    draw = ImageDraw.Draw(sheet)
+    # Font mặc định của PIL không có dấu tiếng Việt, dùng lại font tên của template ở cỡ nhỏ
+    font = _render_template_for(None)['fonts'][1].font_variant(size=14)
+
+    for index, r in enumerate(results):
+        x = padding + (index % columns) * cell_width
+        y = padding + (index // columns) * cell_height
+        if r['image'] is not None:
+            with Image.open(io.BytesIO(r['image'])) as card:
+                thumb = card.convert("RGB").resize((thumb_width, thumb_height), Image.Resampling.LANCZOS)
+            sheet.paste(thumb, (x, y))
+            label = f"{r['member'].display_name} · {r['ms']:.0f}ms"
+        else:
+            draw.rectangle((x, y, x + thumb_width - 1, y + thumb_height - 1), outline=(237, 66, 69), width=2)
+            label = f"{r['member'].display_name} · LỖI"
+        draw.text((x, y + thumb_height + 3), label, fill=(220, 221, 222), font=font)
+    return _encode_welcome_image(sheet, image_format="webp" if WELCOME_IMAGE_FORMAT == "webp" else "png-rgb")
+
+def build_preview_zip(results, timings_text):
+    """Đóng gói từng ảnh đã render (kèm timings.txt) vào một file zip. Ảnh đã nén sẵn nên chỉ STORED."""
+    extension = WELCOME_IMAGE_EXTENSIONS.get(WELCOME_IMAGE_FORMAT, 'png')
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for index, r in enumerate(results, 1):
+            if r['image'] is not None:
+                archive.writestr(f"{index:02d}_{r['member'].id}.{extension}", r['image'])
+        archive.writestr("timings.txt", timings_text)
+    return buffer.getvalue()
+
+@bot.tree.command(name="testwelcome_bulk", description="Render thử ảnh chào mừng cho nhiều thành viên cùng lúc.")
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(
+    role="Render cho mọi thành viên có role này.",
+    users="Danh sách mention hoặc ID người dùng, cách nhau bằng dấu cách.",
+    last_joiners="Render cho N người join gần nhất.",
+    output="Một ảnh ghép (contact sheet) hay file zip chứa từng ảnh.",
+    use_cache="Dùng ảnh đã cache nếu có (mặc định: render lại để đo thông lượng)."
+)
+@app_commands.choices(output=[
+    app_commands.Choice(name="Contact sheet", value="sheet"),
+    app_commands.Choice(name="Zip", value="zip"),
+])
+@app_commands.checks.has_permissions(administrator=True)
+async def testwelcome_bulk_slash(interaction: discord.Interaction, role: discord.Role = None, users: str = None,
+                                 last_joiners: app_commands.Range[int, 1, BULK_PREVIEW_MAX] = None,
+                                 output: app_commands.Choice[str] = None, use_cache: bool = False):
+    if role is None and not users and not last_joiners:
+        await interaction.response.send_message("Chọn ít nhất một trong `role`, `users` hoặc `last_joiners`.", ephemeral=True)
+        return
+    await interaction.response.defer(thinking=True)
+    try:
+        members, skipped = await collect_bulk_preview_members(interaction.guild, role, users, last_joiners)
+        if not members:
+            await interaction.followup.send("Không tìm thấy thành viên nào để render.")
+            return
+        print(f"DEBUG: Đang render thử {len(members)} ảnh chào mừng (song song {BULK_PREVIEW_CONCURRENCY})...")
+        results, total_seconds = await render_bulk_previews(members, BULK_PREVIEW_CONCURRENCY, use_cache)
+        summary, timings_text = format_bulk_preview_timings(results, total_seconds, BULK_PREVIEW_CONCURRENCY)
+        if skipped:
+            summary += f" Bỏ qua {skipped} thành viên (giới hạn {BULK_PREVIEW_MAX})."
+
+        if output is not None and output.value == "zip":
+            payload = await asyncio.to_thread(build_preview_zip, results, timings_text)
+            filename = "welcome_previews.zip"
+        else:
+            payload = await asyncio.to_thread(build_contact_sheet, results)
+            filename = welcome_image_filename("welcome_previews", "webp" if WELCOME_IMAGE_FORMAT == "webp" else "png")
+        if len(payload) > interaction.guild.filesize_limit:
+            await interaction.followup.send(f"{summary}\nFile kết quả quá lớn ({len(payload) / 1024 / 1024:.1f}MB), thử ít thành viên hơn.",
+                                            file=discord.File(fp=io.BytesIO(timings_text.encode("utf-8")), filename="timings.txt"))
+            return
+        files = [discord.File(fp=io.BytesIO(payload), filename=filename),
+                 discord.File(fp=io.BytesIO(timings_text.encode("utf-8")), filename="timings.txt")]
+        await interaction.followup.send(summary, files=files)
+        print(f"DEBUG: {summary}")
+    except Exception as e:
+        await interaction.followup.send(f"Có lỗi khi render thử hàng loạt: `{e}`")
+        print(f"LỖI BULK PREVIEW: {e}")
+
+# --- Slash Command: /profile ---
+@bot.tree.command(name="profile", description="Lấy mẫu stack event loop trong vài giây (dạng folded cho flamegraph).")
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(seconds=f"Số giây lấy mẫu (tối đa {PROFILE_MAX_SECONDS}).")
+@app_commands.checks.has_permissions(administrator=True)
+async def profile_slash(interaction: discord.Interaction, seconds: app_commands.Range[float, 1, PROFILE_MAX_SECONDS] = 10.0):
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    result = await asyncio.to_thread(sample_loop_profile, seconds)
+    if result is None:
+        await interaction.followup.send("Profiler đang chạy hoặc event loop chưa sẵn sàng, thử lại sau.", ephemeral=True)
+        return
+    folded, samples = result
+    summary = (f"{samples} mẫu trong {seconds:.0f}s. Loop bị chặn {LOOP_WATCHDOG['stalls']} lần "
+               f"(trễ tối đa {LOOP_LAG['max'] * 1000:.0f}ms).")
+    files = [discord.File(fp=io.BytesIO(folded.encode("utf-8")), filename="loop_profile.folded")]
+    if LOOP_STALLS:
+        files.append(discord.File(fp=io.BytesIO(format_loop_stalls().encode("utf-8")), filename="loop_stalls.txt"))
+    await interaction.followup.send(summary, files=files, ephemeral=True)
+
 # --- Slash Command: /link ---
 @bot.tree.command(name="link", description="Tạo một dòng chữ chứa link rút gọn (Markdown).")
 @app_commands.describe(
@@ -455,37 +2381,87 @@ async def create_link(interaction: discord.Interaction, url: str, text: str = "L
     
     # Gửi tin nhắn kèm tên người dùng
     await interaction.response.send_message(f"✨ **{user_name}** đã chia sẻ: {formatted_link}")
-# --- Sự kiện on_ready ---
-@bot.event
-async def on_ready():
+# --- Đồng bộ slash command chỉ khi định nghĩa thay đổi ---
+# Đặt FORCE_COMMAND_SYNC=1 để luôn sync khi khởi động
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+
+def command_tree_fingerprint(tree):
+    """Hash ổn định của toàn bộ định nghĩa slash command (tên, mô tả, tham số, quyền)."""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda d: (d.get('type', 1), d['name']))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def sync_commands_if_changed(force=False):
+    """Gọi bot.tree.sync() khi fingerprint khác bản đã lưu (theo application id). Trả về số lệnh đã sync hoặc None nếu bỏ qua."""
+    fingerprint = command_tree_fingerprint(bot.tree)
+    app_key = str(bot.application_id)
+    synced_state = _load_bot_state().get('command_sync', {})
+    if not force and synced_state.get(app_key) == fingerprint:
+        print("✅ Slash commands không thay đổi, bỏ qua đồng bộ.")
+        return None
+    synced = await bot.tree.sync()
+    synced_state[app_key] = fingerprint
+    _save_bot_state(command_sync=synced_state)
+    print(f"✅ Đã đồng bộ {len(synced)} lệnh slash commands.")
+    return len(synced)
+
+def _init_resources_once():
+    """Tài nguyên chỉ khởi tạo một lần mỗi process (on_ready chạy lại mỗi lần gateway reconnect)."""
     global IMAGE_GEN_SEMAPHORE
+    if getattr(bot, "resources_loaded", False):
+        return
+    bot.resources_loaded = True
     # THÊM DÒNG NÀY: Khởi tạo session để tải ảnh nhanh hơn
     if not hasattr(bot, 'session'):
         bot.session = aiohttp.ClientSession()
-        
     if IMAGE_GEN_SEMAPHORE is None:
-        IMAGE_GEN_SEMAPHORE = asyncio.Semaphore(2)
-    
+        IMAGE_GEN_SEMAPHORE = asyncio.Semaphore(IMAGE_GEN_CONCURRENCY)
+    JOIN_QUEUE.start()
+    OUTBOUND.start()
     _load_fonts(FONT_MAIN_PATH, FONT_SYMBOL_PATH)
     _load_background_image(BACKGROUND_IMAGE_PATH, DEFAULT_IMAGE_DIMENSIONS)
+    _build_render_template()
+    _start_render_executor()
+
+# --- Sự kiện on_ready ---
+@bot.event
+async def on_ready():
+    _init_resources_once()
     
+    if not getattr(bot, "ready_logged", False):
+        bot.ready_logged = True
+        print(f"⏱️ Từ lúc khởi động tới khi sẵn sàng: {time.time() - PROCESS_STARTED_AT:.1f}s")
+        # Đăng nhập thành công: lần khởi động sau không cần chờ
+        _save_bot_state(login={'failures': 0, 'retry_until': 0, 'last_attempt': time.time()}, last_ready=time.time())
+
     print("===================================")
     print(f"🤖 Bot đã đăng nhập thành công!")
     print(f"👤 Tên bot    : {bot.user} (ID: {bot.user.id})")
     print(f"🌐 Server(s) : {len(bot.guilds)}")
+    if SHARD_OPTIONS is not None:
+        print(f"🧩 Shard(s)  : {bot.shard_ids or 'tất cả'} / {bot.shard_count}")
     print("===================================")
     
-    try:
-        synced = await bot.tree.sync()
-        print(f"✅ Đã đồng bộ {len(synced)} lệnh slash commands.")
-    except Exception as e:
-        print(f"❌ Lỗi khi đồng bộ slash command: {e}")
+    if not getattr(bot, "commands_synced", False) and IS_PRIMARY_SHARD_PROCESS:
+        try:
+            await sync_commands_if_changed(force=FORCE_COMMAND_SYNC)
+            bot.commands_synced = True
+        except Exception as e:
+            print(f"❌ Lỗi khi đồng bộ slash command: {e}")
+    elif not IS_PRIMARY_SHARD_PROCESS:
+        print("DEBUG: Bỏ qua sync slash command: chỉ process chạy shard 0 được sync.")
         
     if not getattr(bot, "bg_tasks_started", False):
         bot.bg_tasks_started = True
         bot.loop.create_task(activity_heartbeat_worker())
         bot.loop.create_task(random_message_worker())
         bot.loop.create_task(flask_ping_worker())
+        bot.loop.create_task(metrics_snapshot_worker())
+        bot.loop.create_task(loop_heartbeat_worker())
+        if MEMORY_REPORT_INTERVAL > 0:
+            bot.loop.create_task(memory_report_worker())
+        if AVATAR_WARMUP_ENABLED:
+            bot.loop.create_task(avatar_warmup_worker())
+        bot.loop.create_task(guild_config_reload_worker())
         active_developer_maintenance.start()
         print("⚙️ Background workers đã được khởi động.")
 
@@ -504,39 +2480,189 @@ async def flask_ping_worker():
         except Exception as e:
             print(f"LỖI PING FLASK: {e}")
 
+# --- Hàng đợi chào mừng: gom các lượt join dồn dập vào pipeline render cố định ---
+def _random_welcome_text(member):
+    welcome_messages = [
+        f"**<a:cat2:1323314096040448145>** **Chào mừng {member.mention} đã đến với {member.guild.name}!** ✨",
+        f"👋 **Xin chào {member.mention}, chúc bạn chơi vui tại {member.guild.name}**! **<a:cat2:1323314096040448145>**",
+        f"**<a:cat2:1323314096040448145>** **{member.mention} đã gia nhập băng đẳng {member.guild.name}**! 🥳",
+        f"**<a:cat2:1323314096040448145>** **{member.mention} đã join party! Cả team {member.guild.name} ready chưa?**! 🎮",
+        f"🌟 **{member.mention} đã mở khóa map {member.guild.name}! Chúc mừng thí chủ ** **<a:cat2:1323314096040448145>**",
+    ]
+    return random.choice(welcome_messages)
+
+class WelcomeJoinQueue:
+    """Hàng đợi lượt join có giới hạn, xử lý bởi số worker render cố định.
+
+    - Khi số lượt đang chờ vượt `text_only_threshold`, lượt join mới chỉ được chào bằng chữ (không render ảnh).
+    - Hàng đợi đầy thì `submit` phải chờ (backpressure) thay vì tạo thêm task render.
+    - Sender gom các lời chào đang chờ cùng kênh vào một tin nhắn, tối đa 10 file/tin nhắn như giới hạn của Discord.
+    """
+
+    def __init__(self, workers, max_size, text_only_threshold, batch_window=0.0):
+        self.workers = workers
+        self.text_only_threshold = text_only_threshold
+        self.batch_window = batch_window
+        self._jobs = asyncio.Queue(maxsize=max_size)
+        self._outbox = asyncio.Queue()
+        self._tasks = []
+        self.enqueued = 0
+        self.rendered = 0
+        self.degraded = 0
+        self.render_errors = 0
+        self.messages_sent = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self._total_wait = 0.0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._render_worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sender()))
+        print(f"DEBUG: Hàng đợi chào mừng chạy với {self.workers} worker render.")
+
+    def depth(self):
+        return self._jobs.qsize()
+
+    async def submit(self, member, channel):
+        self.start()
+        self.enqueued += 1
+        now = asyncio.get_running_loop().time()
+        if self._jobs.qsize() >= self.text_only_threshold:
+            self.degraded += 1
+            print(f"DEBUG: Hàng đợi chào mừng đang dồn ({self._jobs.qsize()} lượt), chào {member.display_name} bằng chữ.")
+            await self._outbox.put((channel, member, None, now, WelcomeTrace(f"join-text:{member.display_name}")))
+            return
+        await self._jobs.put((channel, member, now))
+
+    async def _render_worker(self, worker_id):
+        while True:
+            channel, member, enqueued_at = await self._jobs.get()
+            try:
+                wait = asyncio.get_running_loop().time() - enqueued_at
+                self.last_wait = wait
+                self.max_wait = max(self.max_wait, wait)
+                self._total_wait += wait
+                trace = WelcomeTrace(f"join:{member.display_name}", started=time.perf_counter() - wait)
+                trace.record("queue_wait", wait * 1000)
+                image_bytes = None
+                try:
+                    print(f"DEBUG: Đang tạo ảnh chào mừng cho {member.display_name}...")
+                    image_bytes = await create_welcome_image_limited(member, trace)
+                    self.rendered += 1
+                except Exception as e:
+                    self.render_errors += 1
+                    trace.note("error", type(e).__name__)
+                    print(f"LỖI CHÀO MỪNG KHÁC: Lỗi khi tạo ảnh chào mừng cho {member.display_name}: {e}")
+                await self._outbox.put((channel, member, image_bytes, enqueued_at, trace))
+            finally:
+                self._jobs.task_done()
+
+    async def _collect_batch(self):
+        batch = [await self._outbox.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < DISCORD_MAX_FILES * 2:
+            try:
+                batch.append(self._outbox.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._outbox.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @staticmethod
+    def _split_messages(items):
+        """Chia các lời chào cùng kênh thành nhiều tin nhắn: tối đa 10 file và ~1900 ký tự mỗi tin."""
+        chunk, files, length = [], 0, 0
+        for item in items:
+            text = _random_welcome_text(item[1])
+            has_file = item[2] is not None
+            if chunk and (files + has_file > DISCORD_MAX_FILES or length + len(text) > 1900):
+                yield chunk
+                chunk, files, length = [], 0, 0
+            chunk.append((item, text))
+            files += has_file
+            length += len(text) + 1
+        if chunk:
+            yield chunk
+
+    async def _sender(self):
+        while True:
+            batch = await self._collect_batch()
+            by_channel = {}
+            for item in batch:
+                by_channel.setdefault(item[0].id, []).append(item)
+            for items in by_channel.values():
+                channel = items[0][0]
+                for chunk in self._split_messages(items):
+                    await self._send_chunk(channel, chunk)
+
+    async def _send_chunk(self, channel, chunk):
+        content = "\n".join(text for _, text in chunk)
+        files = [discord.File(fp=item[2], filename=welcome_image_filename(f"welcome_{i}" if len(chunk) > 1 else "welcome"))
+                 for i, (item, _) in enumerate(chunk) if item[2] is not None]
+        names = ", ".join(item[1].display_name for item, _ in chunk)
+        send_started = time.perf_counter()
+        try:
+            await OUTBOUND.send(channel, content, files=files, priority=PRIORITY_WELCOME)
+            self.messages_sent += 1
+            print(f"Đã gửi ảnh chào mừng thành công cho {names}!")
+        except (discord.errors.HTTPException, discord.errors.RateLimited) as e:
+            print(f"LỖI HTTP DISCORD: Lỗi khi gửi ảnh chào mừng: {e}")
+            rate_limited = isinstance(e, discord.errors.RateLimited) or getattr(e, 'status', None) == 429
+            if files and not rate_limited:
+                # Gửi lại chỉ bằng chữ, không kèm ảnh (không gửi lại khi bị 429, tin thứ hai cũng sẽ bị chặn)
+                try:
+                    lines = [f"Chào mừng {item[1].mention} đã đến với {item[1].guild.name}!" for item, _ in chunk]
+                    await OUTBOUND.send(channel, "\n".join(lines) + " (Có lỗi khi tạo ảnh chào mừng, xin lỗi!)", priority=PRIORITY_WELCOME)
+                    self.messages_sent += 1
+                except Exception as e2:
+                    print(f"LỖI HTTP DISCORD: Không gửi được lời chào dự phòng: {e2}")
+        except Exception as e:
+            print(f"LỖI CHÀO MỪNG KHÁC: Lỗi khi gửi lời chào cho {names}: {e}")
+        finally:
+            send_ms = (time.perf_counter() - send_started) * 1000
+            for item, _ in chunk:
+                item[4].record("send", send_ms)
+                item[4].finish()
+
+    def stats(self):
+        waited = self.rendered + self.render_errors
+        return {
+            'depth': self._jobs.qsize(),
+            'outbox': self._outbox.qsize(),
+            'enqueued': self.enqueued,
+            'rendered': self.rendered,
+            'degraded': self.degraded,
+            'render_errors': self.render_errors,
+            'messages_sent': self.messages_sent,
+            'last_wait_seconds': self.last_wait,
+            'max_wait_seconds': self.max_wait,
+            'avg_wait_seconds': (self._total_wait / waited) if waited else 0.0,
+        }
+
+JOIN_QUEUE = WelcomeJoinQueue(JOIN_RENDER_WORKERS, JOIN_QUEUE_MAX, JOIN_TEXT_ONLY_THRESHOLD, JOIN_BATCH_WINDOW)
+
 @bot.event
 async def on_member_join(member):
-    channel_id = 1322848542758277202
-    channel = bot.get_channel(channel_id)
+    count_shard_event(member.guild, "member_join")
+    channel_id = GUILD_CONFIG.get(member.guild.id).welcome_channel_id
+    channel = member.guild.get_channel(channel_id) if channel_id else None
     if channel is None:
         print(f"LỖI KÊNH: Không tìm thấy kênh với ID {channel_id}.")
         return
     if not channel.permissions_for(member.guild.me).send_messages or not channel.permissions_for(member.guild.me).attach_files:
         print(f"LỖI QUYỀN: Bot không có quyền gửi tin nhắn hoặc đính kèm file trong kênh {channel.name}.")
         return
-    try:
-        print(f"DEBUG: Đang tạo ảnh chào mừng cho {member.display_name}...")
-        if IMAGE_GEN_SEMAPHORE:
-            async with IMAGE_GEN_SEMAPHORE:
-                image_bytes = await create_welcome_image(member)
-        else:
-            image_bytes = await create_welcome_image(member)
-        welcome_messages = [
-            f"**<a:cat2:1323314096040448145>** **Chào mừng {member.mention} đã đến với {member.guild.name}!** ✨",
-            f"👋 **Xin chào {member.mention}, chúc bạn chơi vui tại {member.guild.name}**! **<a:cat2:1323314096040448145>**",
-            f"**<a:cat2:1323314096040448145>** **{member.mention} đã gia nhập băng đẳng {member.guild.name}**! 🥳",
-            f"**<a:cat2:1323314096040448145>** **{member.mention} đã join party! Cả team {member.guild.name} ready chưa?**! 🎮",
-            f"🌟 **{member.mention} đã mở khóa map {member.guild.name}! Chúc mừng thí chủ ** **<a:cat2:1323314096040448145>**",
-        ]
-        welcome_text = random.choice(welcome_messages)
-        await channel.send(welcome_text, file=discord.File(fp=image_bytes, filename='welcome.png'))
-        print(f"Đã gửi ảnh chào mừng thành công cho {member.display_name}!")
-    except discord.errors.HTTPException as e:
-        print(f"LỖI HTTP DISCORD: Lỗi khi gửi ảnh chào mừng: {e}")
-        await channel.send(f"Chào mừng {member.mention} đã đến với {member.guild.name}! (Có lỗi khi tạo ảnh chào mừng, xin lỗi!)")
-    except Exception as e:
-        print(f"LỖỖI CHÀO MỪNG KHÁC: Lỗi khi tạo hoặc gửi ảnh chào mừng: {e}")
-        await channel.send(f"Chào mừng {member.mention} đã đến với {member.guild.name}!")
+    await JOIN_QUEUE.submit(member, channel)
         
 # Danh sách role xếp hạng (cao -> thấp)
 RANK_ROLES = [1416629995534811176,
@@ -561,102 +2687,496 @@ ROLE_DISPLAY = {
     1322844864760516691: "🐣 **Tân Giả**",
 }
 
+# Gom các lần cập nhật role liên tiếp (vd bot level cộng nhiều role một lúc) trong cửa sổ này thành 1 lần xử lý
+RANK_DEBOUNCE_SECONDS = float(os.getenv("RANK_DEBOUNCE_SECONDS", "2.0"))
+# Discord cho tối đa 10 embed mỗi tin nhắn
+RANK_EMBEDS_PER_MESSAGE = 10
+
+class RankConfig:
+    """Bảng xếp hạng đã đánh chỉ mục: role_id -> hạng (0 là cao nhất) và tập role thấp hơn của từng hạng."""
+
+    def __init__(self, ranks, notify_channel_id, display=None):
+        self.ranks = [int(role_id) for role_id in ranks]
+        self.notify_channel_id = int(notify_channel_id) if notify_channel_id else None
+        self.display = {int(role_id): text for role_id, text in (display or {}).items()}
+        self.rank_of = {role_id: index for index, role_id in enumerate(self.ranks)}
+        self.lower_of = [frozenset(self.ranks[index + 1:]) for index in range(len(self.ranks))]
+
+class RankEngine:
+    """Xử lý thăng cấp: tra role mới trong O(1), gom theo thành viên và gửi thông báo theo lô.
+
+    - Mỗi server gom sự kiện trong `debounce` giây, mỗi thành viên chỉ lấy hạng cao nhất vừa nhận.
+    - Mỗi thành viên chỉ có một lần `edit(roles=...)` để bỏ các role thấp hơn.
+    - Thông báo của nhiều thành viên được gộp, tối đa 10 embed mỗi tin nhắn.
+    """
+
+    def __init__(self, debounce=RANK_DEBOUNCE_SECONDS):
+        self.debounce = debounce
+        self._pending = {}
+        self._flush_tasks = {}
+        self.updates_seen = 0
+        self.rank_hits = 0
+        self.promotions = 0
+        self.role_edits = 0
+        self.announce_messages = 0
+
+    def config_for(self, guild_id):
+        return GUILD_CONFIG.get(guild_id).ranks
+
+    def observe(self, before, after):
+        """Gọi từ on_member_update. Chỉ tra các role vừa được thêm trong bảng hạng."""
+        self.updates_seen += 1
+        new_role_ids = {role.id for role in after.roles} - {role.id for role in before.roles}
+        if not new_role_ids:
+            return
+        config = self.config_for(after.guild.id)
+        ranks = [config.rank_of[role_id] for role_id in new_role_ids if role_id in config.rank_of]
+        if not ranks:
+            return
+        best = min(ranks)
+        self.rank_hits += 1
+        pending = self._pending.setdefault(after.guild.id, {})
+        previous = pending.get(after.id)
+        pending[after.id] = (after, best if previous is None else min(best, previous[1]))
+        if after.guild.id not in self._flush_tasks:
+            self._flush_tasks[after.guild.id] = asyncio.create_task(self._flush_later(after.guild))
+
+    async def _flush_later(self, guild):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            self._flush_tasks.pop(guild.id, None)
+        pending = self._pending.pop(guild.id, {})
+        if pending:
+            await self._flush(guild, list(pending.values()))
+
+    async def _flush(self, guild, promotions):
+        config = self.config_for(guild.id)
+        embeds = []
+        edits = []
+        for member, rank in promotions:
+            # Lấy bản mới nhất trong cache, phòng khi thành viên được cập nhật tiếp sau sự kiện cuối
+            member = guild.get_member(member.id) or member
+            role = guild.get_role(config.ranks[rank])
+            if role is None:
+                continue
+            self.promotions += 1
+            embed = discord.Embed(
+                title="⬆ LEVEL UP ⬆",
+                description=(f"Xin chúc mừng {member.mention} đã thăng cấp lên {config.display.get(role.id, role.name)}!"),
+                color=role.color if role.color.value else discord.Color.gold()
+            )
+            embed.set_thumbnail(url=member.display_avatar.url)
+            embeds.append(embed)
+
+            # TỐI ƯU: Xóa tất cả role thấp hơn trong 1 lần gửi yêu cầu duy nhất
+            lower_role_ids = config.lower_of[rank]
+            final_roles = [r for r in member.roles if r.id not in lower_role_ids]
+            if len(final_roles) != len(member.roles):
+                edits.append(self._edit_roles(member, final_roles))
+
+        channel = guild.get_channel(config.notify_channel_id) if config.notify_channel_id else None
+        if channel is not None:
+            for start in range(0, len(embeds), RANK_EMBEDS_PER_MESSAGE):
+                await OUTBOUND.send(channel, embeds=embeds[start:start + RANK_EMBEDS_PER_MESSAGE], priority=PRIORITY_LEVEL_UP, wait=False)
+                self.announce_messages += 1
+        if edits:
+            await asyncio.gather(*edits)
+
+    async def _edit_roles(self, member, final_roles):
+        try:
+            await OUTBOUND.submit(PRIORITY_ROLE_EDIT, ("member_edit", member.guild.id), lambda: member.edit(roles=final_roles),
+                                  label=f"roles:{member.display_name}")
+            self.role_edits += 1
+            print(f"Đã tối ưu: Xóa các role thấp cho {member.display_name}")
+        except Exception as e:
+            print(f"LỖI XẾP HẠNG: Không xóa được role thấp cho {member.display_name}: {e}")
+
+    def stats(self):
+        return {
+            'updates_seen': self.updates_seen,
+            'rank_hits': self.rank_hits,
+            'promotions': self.promotions,
+            'role_edits': self.role_edits,
+            'announce_messages': self.announce_messages,
+            'pending': sum(len(pending) for pending in self._pending.values()),
+        }
+
+# --- Config theo từng server (kênh chào mừng, kênh thông báo, xếp hạng, tin nhắn ngẫu nhiên, nền / font) ---
+# File JSON dạng {"<guild_id>": {"welcome_channel_id": ..., "notify_channel_id": ..., "ranks": [role_id cao -> thấp],
+#   "role_display": {"<role_id>": "tên đẹp"}, "random_channel_id": ..., "random_messages": [...],
+#   "background": "nen.png", "font_main": "...", "font_symbol": "..."}}
+# Khóa nào thiếu thì lấy theo hằng số mặc định ở trên. File được đọc lại khi mtime thay đổi, không cần restart.
+GUILD_CONFIG_PATH = os.getenv("GUILD_CONFIG_PATH", "guild_config.json")
+GUILD_CONFIG_RELOAD_INTERVAL = float(os.getenv("GUILD_CONFIG_RELOAD_INTERVAL", "15"))
+
+class GuildConfig:
+    def __init__(self, welcome_channel_id, notify_channel_id, ranks, role_display, random_channel_id, random_messages,
+                 background_path, font_main_path, font_symbol_path, generation=0):
+        self.welcome_channel_id = int(welcome_channel_id) if welcome_channel_id else None
+        self.random_channel_id = int(random_channel_id) if random_channel_id else None
+        self.random_messages = list(random_messages)
+        self.ranks = RankConfig(ranks, notify_channel_id, role_display)
+        self.background_path = background_path
+        self.font_main_path = font_main_path
+        self.font_symbol_path = font_symbol_path
+        # None = nền / font mặc định (dùng RENDER_TEMPLATE); khác thì là khóa template riêng của server.
+        # Kèm `generation` (số lần tải config) để reload làm mới template và ảnh đã cache, cả trong process render
+        paths = (background_path, font_main_path, font_symbol_path)
+        self.style = None if paths == (BACKGROUND_IMAGE_PATH, FONT_MAIN_PATH, FONT_SYMBOL_PATH) else (*paths, generation)
+
+    @classmethod
+    def from_dict(cls, data, base, generation=0):
+        return cls(
+            data.get('welcome_channel_id', base.welcome_channel_id),
+            data.get('notify_channel_id', base.ranks.notify_channel_id),
+            data.get('ranks', base.ranks.ranks),
+            data.get('role_display', base.ranks.display),
+            data.get('random_channel_id', base.random_channel_id),
+            data.get('random_messages', base.random_messages),
+            data.get('background', base.background_path),
+            data.get('font_main', base.font_main_path),
+            data.get('font_symbol', base.font_symbol_path),
+            generation,
+        )
+
+class GuildConfigStore:
+    """Config từng server, đọc từ file vào dict trong RAM: tra cứu trong event handler chỉ là một lần dict.get."""
+
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+        self._index = {}
+        self._mtime = None
+        self.reloads = 0
+
+    def get(self, guild_id):
+        return self._index.get(guild_id, self.default)
+
+    @staticmethod
+    def _read_json(path):
+        if not path or not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+
+    def load(self):
+        """Đọc lại file và thay index trong một lần gán. File lỗi thì giữ nguyên index cũ."""
+        mtime = self._file_mtime()
+        try:
+            data = self._read_json(self.path)
+            generation = self.reloads + 1
+            index = {int(guild_id): GuildConfig.from_dict(conf, self.default, generation) for guild_id, conf in data.items()}
+        except Exception as e:
+            print(f"LỖI CONFIG SERVER: Không đọc được config, giữ bản đang dùng: {e}")
+            self._mtime = mtime
+            return False
+        self._index = index
+        self._mtime = mtime
+        self.reloads += 1
+        # Nền / font có thể đã đổi: style mới mang generation mới; bỏ luôn template cũ trong process này cho nhẹ RAM
+        with _GUILD_TEMPLATES_LOCK:
+            _GUILD_TEMPLATES.clear()
+        print(f"DEBUG: Đã tải config cho {len(index)} server.")
+        return True
+
+    def reload_if_changed(self):
+        if self._file_mtime() != self._mtime:
+            return self.load()
+        return False
+
+    def stats(self):
+        return {'guilds': len(self._index), 'reloads': self.reloads, 'templates_cached': len(_GUILD_TEMPLATES)}
+
+GUILD_CONFIG = GuildConfigStore(GUILD_CONFIG_PATH, GuildConfig(
+    WELCOME_CHANNEL_ID, NOTIFY_CHANNEL_ID, RANK_ROLES, ROLE_DISPLAY, RANDOM_CHANNEL_ID, RANDOM_MESSAGES,
+    BACKGROUND_IMAGE_PATH, FONT_MAIN_PATH, FONT_SYMBOL_PATH,
+))
+GUILD_CONFIG.load()
+
+async def guild_config_reload_worker():
+    """Kiểm tra mtime file config định kỳ, đọc lại khi có thay đổi."""
+    while True:
+        await asyncio.sleep(GUILD_CONFIG_RELOAD_INTERVAL)
+        try:
+            GUILD_CONFIG.reload_if_changed()
+        except Exception as e:
+            print(f"LỖI CONFIG SERVER: {e}")
+
+RANK_ENGINE = RankEngine()
+
 @bot.event
 async def on_member_update(before: discord.Member, after: discord.Member):
-    before_roles = set(before.roles)
-    after_roles = set(after.roles)
-    new_roles = after_roles - before_roles
-    
-    if not new_roles: return
-    
-    for role_id in RANK_ROLES:
-        role = after.guild.get_role(role_id)
-        if role in new_roles:
-            # Gửi thông báo thăng cấp
-            channel = after.guild.get_channel(NOTIFY_CHANNEL_ID)
-            if channel:
-                role_display = ROLE_DISPLAY.get(role.id, role.name)
-                embed = discord.Embed(
-                    title="⬆ LEVEL UP ⬆",
-                    description=(f"Xin chúc mừng {after.mention} đã thăng cấp lên {role_display}!"),
-                    color=role.color if role.color.value else discord.Color.gold()
-                )
-                embed.set_thumbnail(url=after.display_avatar.url)
-                await channel.send(embed=embed)
+    count_shard_event(after.guild, "member_update")
+    RANK_ENGINE.observe(before, after)
 
-            # TỐI ƯU: Xóa tất cả role thấp hơn trong 1 lần gửi yêu cầu duy nhất
-            role_index = RANK_ROLES.index(role_id)
-            lower_role_ids = set(RANK_ROLES[role_index + 1:])
-            
-            # Tạo danh sách role mới (loại bỏ các role thấp)
-            final_roles = [r for r in after.roles if r.id not in lower_role_ids]
-            
-            if len(final_roles) != len(after.roles):
-                await after.edit(roles=final_roles)
-                print(f"Đã tối ưu: Xóa các role thấp cho {after.display_name}")
-            break
 # --- Auto Reply theo keyword ---
-# 1. Thiết lập Cooldown: cho phép 1 tin nhắn mỗi 5 giây trên mỗi người dùng
-# (Bạn có thể chỉnh 1, 5 thành số khác tùy nhu cầu)
-_cooldown = commands.CooldownMapping.from_cooldown(1, 5, commands.BucketType.user)
+# Trigger đọc từ AUTO_REPLY_CONFIG_PATH (JSON), không có file thì dùng DEFAULT_AUTO_REPLIES.
+# Mỗi trigger: {"type": "exact" | "prefix" | "word" | "regex", "pattern": "...", "response": "...",
+#               "channel_cooldown": [số lần, giây]}
+# response là template, chỉ format khi khớp: {mention}, {name}, {channel}
+AUTO_REPLY_CONFIG_PATH = os.getenv("AUTO_REPLY_CONFIG_PATH", "auto_replies.json")
+# 1 câu trả lời mỗi 5 giây trên mỗi người dùng (chung mọi trigger, như trước); mặc định 3 tin nhắn mỗi 5 giây
+# trên mỗi kênh, tính riêng từng trigger
+AUTO_REPLY_USER_COOLDOWN = (1, 5)
+AUTO_REPLY_CHANNEL_COOLDOWN = (3, 5)
+DEFAULT_AUTO_REPLIES = [
+    {"type": "exact", "pattern": "ping", "response": "Pong 🏓"},
+    {"type": "exact", "pattern": "hello", "response": "Chào {mention} 😎"},
+    {"type": "exact", "pattern": "hi", "response": "Chào {mention} <a:2:1387245423185498265>"},
+    {"type": "exact", "pattern": "có ai ko", "response": "Có tui nè {mention} 😘"},
+]
+
+class AutoReplyTrigger:
+    def __init__(self, index, kind, pattern, response, channel_cooldown, compiled=None):
+        self.index = index
+        self.kind = kind
+        self.pattern = pattern
+        self.response = response
+        # Regex đã compile riêng (chỉ với type "regex")
+        self.compiled = compiled
+        # Mỗi trigger có bucket theo kênh riêng; cooldown theo người dùng dùng chung cho mọi trigger (xem AutoReplyEngine)
+        self.channel_cooldown = commands.CooldownMapping.from_cooldown(*channel_cooldown, commands.BucketType.channel)
+
+    def render(self, message):
+        return self.response.format(
+            mention=message.author.mention,
+            name=message.author.display_name,
+            channel=getattr(message.channel, 'mention', ''),
+        )
+
+class AutoReplyEngine:
+    """Bộ so khớp auto reply dựng một lần lúc khởi động.
+
+    Trigger `exact` tra trong dict theo nội dung đã lower/strip. Các keyword `prefix` và `word` (đã escape)
+    được ghép thành một regex duy nhất, mỗi trigger là một named group, nên chỉ quét tin nhắn một lần.
+    Trigger `regex` do người dùng viết được compile và so khớp riêng (flag, group, backreference giữ nguyên nghĩa).
+    Thứ tự ưu tiên: exact, rồi keyword, rồi regex theo thứ tự trong config.
+    Cooldown theo người dùng dùng chung cho mọi trigger như _cooldown cũ: mỗi người chỉ nhận một câu trả lời mỗi cửa sổ.
+    """
+
+    def __init__(self, entries, user_cooldown=AUTO_REPLY_USER_COOLDOWN):
+        self.triggers = []
+        self.exact = {}
+        self.regex_triggers = []
+        self.user_cooldown = commands.CooldownMapping.from_cooldown(*user_cooldown, commands.BucketType.user)
+        alternatives = []
+        for entry in entries:
+            trigger = self._build_trigger(len(self.triggers), entry)
+            if trigger is None:
+                continue
+            self.triggers.append(trigger)
+            if trigger.kind == "exact":
+                self.exact.setdefault(trigger.pattern, trigger)
+            elif trigger.kind == "prefix":
+                alternatives.append(f"(?P<t{trigger.index}>^{re.escape(trigger.pattern)})")
+            elif trigger.kind == "word":
+                alternatives.append(f"(?P<t{trigger.index}>(?<!\\w){re.escape(trigger.pattern)}(?!\\w))")
+            else:
+                self.regex_triggers.append(trigger)
+        self.matcher = re.compile("|".join(alternatives)) if alternatives else None
+        self.hits = 0
+        self.cooldown_skips = 0
+
+    @staticmethod
+    def _build_trigger(index, entry):
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError("trigger phải là object JSON")
+            kind = entry.get("type", "exact")
+            pattern = entry.get("pattern", "")
+            response = entry.get("response", "")
+            if kind not in ("exact", "prefix", "word", "regex") or not isinstance(pattern, str) or not isinstance(response, str) \
+                    or not pattern or not response:
+                raise ValueError("thiếu pattern/response hoặc type không hợp lệ")
+            channel_cooldown = entry.get("channel_cooldown", AUTO_REPLY_CHANNEL_COOLDOWN)
+            if not isinstance(channel_cooldown, (list, tuple)) or len(channel_cooldown) != 2 \
+                    or not all(isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0 for value in channel_cooldown):
+                raise ValueError("channel_cooldown phải là [số lần, giây]")
+            pattern = pattern.lower().strip() if kind != "regex" else pattern
+            compiled = re.compile(pattern) if kind == "regex" else None
+            # Kiểm tra template ngay lúc tải để không lỗi khi đang trả lời
+            response.format(mention="", name="", channel="")
+            return AutoReplyTrigger(index, kind, pattern, response, channel_cooldown, compiled)
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError, re.error) as e:
+            print(f"LỖI CONFIG AUTO REPLY: Bỏ qua trigger {entry!r}: {e}")
+            return None
+
+    @classmethod
+    def from_config(cls, path):
+        entries = DEFAULT_AUTO_REPLIES
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+                if not isinstance(entries, list):
+                    raise ValueError("file phải là một danh sách trigger")
+                print(f"DEBUG: Đã tải {len(entries)} trigger auto reply từ {path}.")
+            except Exception as e:
+                print(f"LỖI CONFIG AUTO REPLY: Không đọc được {path}, dùng mặc định: {e}")
+                entries = DEFAULT_AUTO_REPLIES
+        return cls(entries)
+
+    def match(self, content):
+        """Trả về trigger khớp với nội dung (đã lower/strip) hoặc None."""
+        trigger = self.exact.get(content)
+        if trigger is not None:
+            return trigger
+        if self.matcher is not None:
+            found = self.matcher.search(content)
+            if found is not None:
+                return self.triggers[int(found.lastgroup[1:])]
+        for trigger in self.regex_triggers:
+            if trigger.compiled.search(content):
+                return trigger
+        return None
+
+    def allow(self, trigger, message):
+        """Trừ lượt ở bucket người dùng (chung) và bucket kênh (của trigger) nếu cả hai còn lượt; False nếu đang cooldown."""
+        user_bucket = self.user_cooldown.get_bucket(message)
+        channel_bucket = trigger.channel_cooldown.get_bucket(message)
+        if user_bucket.get_retry_after() or channel_bucket.get_retry_after():
+            return False
+        user_bucket.update_rate_limit()
+        channel_bucket.update_rate_limit()
+        return True
+
+    def reply_for(self, message, content):
+        """Nội dung trả lời nếu khớp và không bị cooldown; None nếu không cần trả lời."""
+        trigger = self.match(content)
+        if trigger is None:
+            return None
+        if not self.allow(trigger, message):
+            self.cooldown_skips += 1
+            return ""
+        self.hits += 1
+        return trigger.render(message)
+
+AUTO_REPLY = AutoReplyEngine.from_config(AUTO_REPLY_CONFIG_PATH)
 
 @bot.event
 async def on_message(message):
+    count_shard_event(message.guild, "message")
     if message.author.bot: 
         return
 
     # strip() để loại bỏ khoảng trắng dư thừa ở đầu/cuối
     content = message.content.lower().strip()
+    if content:
+        reply = AUTO_REPLY.reply_for(message, content)
+        if reply is not None:
+            # reply rỗng nghĩa là đang cooldown: im lặng (chống spam)
+            if reply:
+                await OUTBOUND.send(message.channel, reply, priority=PRIORITY_AUTO_REPLY, wait=False)
+            return
 
-    # Danh sách từ khóa khớp 100%
-    responses = {
-        "ping": "Pong 🏓",
-        "hello": f"Chào {message.author.mention} 😎",
-        "hi": f"Chào {message.author.mention} <a:2:1387245423185498265>",
-        "có ai ko": f"Có tui nè {message.author.mention} 😘"
-    }
+    await bot.process_commands(message)
 
-    # 2. Kiểm tra xem nội dung có khớp TUYỆT ĐỐI trong danh sách không
-    if content in responses:
-        # 3. Kiểm tra Cooldown (Chống spam)
-        bucket = _cooldown.get_bucket(message)
-        retry_after = bucket.update_rate_limit()
-        
-        if retry_after:
-            # Nếu đang bị cooldown thì im lặng (hoặc báo lỗi nếu muốn)
-            return 
+# --- Trạng thái đăng nhập lưu trên đĩa (backoff thích ứng thay cho delay cố định 30s) ---
+# Mỗi process shard giữ file state riêng để các process không ghi đè backoff đăng nhập của nhau
+BOT_STATE_PATH = os.getenv("BOT_STATE_PATH", f".bot_state.shards-{SHARD_IDS_SPEC}.json" if SHARD_IDS else ".bot_state.json")
+LOGIN_BACKOFF_BASE = float(os.getenv("LOGIN_BACKOFF_BASE", "15"))
+LOGIN_BACKOFF_MAX = float(os.getenv("LOGIN_BACKOFF_MAX", "900"))
+PROCESS_STARTED_AT = time.time()
 
-        # Nếu vượt qua cooldown thì mới gửi tin nhắn
-        await message.channel.send(responses[content])
-        return
+def _load_bot_state():
+    try:
+        with open(BOT_STATE_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"LỖI STATE: Không đọc được {BOT_STATE_PATH}, bỏ qua: {e}")
+        return {}
 
-    await bot.process_commands(message)
+def _save_bot_state(**updates):
+    """Ghi đè các khóa trong file state (ghi ra file tạm rồi đổi tên để không hỏng file khi crash)."""
+    state = _load_bot_state()
+    state.update(updates)
+    tmp_path = f"{BOT_STATE_PATH}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, BOT_STATE_PATH)
+    except OSError as e:
+        print(f"LỖI STATE: Không ghi được {BOT_STATE_PATH}: {e}")
+
+def _login_delay(login_state, now):
+    """Số giây cần chờ trước lần đăng nhập tiếp theo.
+    Khởi động sạch (lần trước không lỗi) thì không chờ; chỉ backoff lũy thừa có jitter khi thực sự bị lỗi / 429."""
+    failures = login_state.get('failures', 0)
+    delay = max(0.0, login_state.get('retry_until', 0) - now)
+    if failures:
+        backoff = min(LOGIN_BACKOFF_MAX, LOGIN_BACKOFF_BASE * (2 ** (failures - 1)))
+        backoff *= random.uniform(0.5, 1.0)
+        delay = max(delay, login_state.get('last_attempt', 0) + backoff - now)
+    return delay
+
+def _retry_after_from(e):
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is None and getattr(e, 'response', None) is not None:
+        try:
+            retry_after = float(e.response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            retry_after = None
+    return retry_after
+
+def _record_login_failure(retry_after=None):
+    login_state = _load_bot_state().get('login', {})
+    now = time.time()
+    login_state['failures'] = login_state.get('failures', 0) + 1
+    login_state['retry_until'] = now + retry_after if retry_after else 0
+    _save_bot_state(login=login_state)
+    return login_state
 
 # --- Khởi chạy Flask và Bot Discord ---
 async def start_bot_and_flask():
-    """Hàm async để khởi động Flask + bot Discord với delay và restart chậm (avoid rate limit)."""
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    delay_before_login = 30
-    print(f"DEBUG: Đang đợi {delay_before_login}s trước khi khởi động bot Discord để tránh rate limit...")
-    await asyncio.sleep(delay_before_login)
-    print("DEBUG: Bắt đầu khởi động bot Discord...")
+    """Hàm async để khởi động web server (Flask hoặc aiohttp) + bot Discord, backoff chỉ khi bị rate limit / lỗi."""
+    if WEB_SERVER_MODE == "aiohttp":
+        await start_web_server()
+    else:
+        flask_thread = threading.Thread(target=run_flask)
+        flask_thread.daemon = True
+        flask_thread.start()
+    state = _load_bot_state()
+    login_state = state.get('login', {})
+    if login_state.get('last_attempt', 0) > state.get('last_ready', 0) and not login_state.get('failures'):
+        # Process trước chết giữa lúc đăng nhập và on_ready: coi như một lần lỗi để không spam identify
+        print("DEBUG: Lần khởi động trước không tới được on_ready, áp dụng backoff.")
+        _record_login_failure()
     while True:
+        login_state = _load_bot_state().get('login', {})
+        delay = _login_delay(login_state, time.time())
+        if delay > 0:
+            print(f"DEBUG: Lần đăng nhập trước bị lỗi {login_state.get('failures', 0)} lần, đợi {delay:.0f}s trước khi thử lại để tránh rate limit...")
+            await asyncio.sleep(delay)
+        login_state['last_attempt'] = time.time()
+        _save_bot_state(login=login_state)
+        print("DEBUG: Bắt đầu khởi động bot Discord...")
         try:
             await bot.start(TOKEN)
             break
         except discord.errors.HTTPException as e:
             if getattr(e, 'status', None) == 429:
-                print(f"Lỗi 429 Too Many Requests khi đăng nhập: {e}")
-                print("Có vẻ như Discord đã giới hạn tốc độ đăng nhập. Đợi 5-10 phút trước khi thử lại.")
-                await asyncio.sleep(300)
+                retry_after = _retry_after_from(e)
+                print(f"Lỗi 429 Too Many Requests khi đăng nhập: {e} (retry_after={retry_after})")
+                _record_login_failure(retry_after)
             else:
                 print(f"Một lỗi HTTP khác khi đăng nhập: {e}")
-                await asyncio.sleep(60)
+                _record_login_failure()
+        except discord.errors.RateLimited as e:
+            print(f"Bị giới hạn tốc độ khi đăng nhập, retry_after={e.retry_after}s")
+            _record_login_failure(e.retry_after)
         except Exception as e:
-            print(f"Một lỗi không xác định đã xảy ra: {e}. Restart sau 60s...")
-            await asyncio.sleep(60)
+            print(f"Một lỗi không xác định đã xảy ra: {e}. Sẽ thử lại với backoff...")
+            _record_login_failure()
 
 if __name__ == "__main__":
     try: